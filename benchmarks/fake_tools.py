@@ -0,0 +1,238 @@
+"""
+Stand-in for the package managers and system tools the install and update
+scripts run, so they can be benchmarked without touching the machine. Every
+tool is a symlink to this file, named after the tool it replaces.
+
+Installed packages are kept in FAKE_STATE, so a second run finds what the
+first one installed. Every call takes FAKE_LATENCY_MS, and every package
+installed or upgraded takes that long again, like a real package manager
+would.
+"""
+
+import fcntl
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+STATE_DIR = os.environ["FAKE_STATE"]
+LATENCY = float(os.environ.get("FAKE_LATENCY_MS", "0")) / 1000
+
+
+def delay(packages: int = 0) -> None:
+    """
+    Take as long as a call that changes some packages would.
+    """
+    time.sleep(LATENCY * (1 + packages))
+
+
+@contextmanager
+def state(name: str) -> Iterator[dict]:
+    """
+    Load some state, and save it again afterwards. Tools may run in parallel,
+    so only one of them has it at a time.
+    """
+    path = os.path.join(STATE_DIR, f"{name}.json")
+    with open(os.path.join(STATE_DIR, f"{name}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path, "r") as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            data = {}
+
+        before = json.dumps(data)
+        yield data
+
+        if json.dumps(data) != before:
+            with open(path, "w") as fp:
+                json.dump(data, fp)
+
+
+def sudo(args: list[str]) -> int:
+    # sudo -v and sudo -n -v only refresh the credentials
+    if all(arg.startswith("-") for arg in args):
+        return 0
+    while args[0].startswith("-"):
+        args = args[1:]
+    os.execvp(args[0], args)
+    return 1
+
+
+def apt_get(args: list[str]) -> int:
+    # drop configuration options, which take a value
+    while "-o" in args:
+        i = args.index("-o")
+        args = args[:i] + args[i + 2 :]
+
+    packages = [arg for arg in args[1:] if not arg.startswith("-")]
+    command = next(arg for arg in args if not arg.startswith("-"))
+
+    if "-s" in args:
+        # simulations, which find nothing to do
+        delay()
+        return 0
+
+    if command == "install":
+        with state("apt") as installed:
+            new = [p for p in packages if p not in installed]
+            for package in packages:
+                installed[package] = "1.0"
+        delay(len(new))
+        print(f"0 upgraded, {len(new)} newly installed, 0 to remove")
+    elif command == "upgrade":
+        delay()
+        print("0 upgraded, 0 newly installed, 0 to remove")
+    elif command == "autoremove":
+        delay()
+        print("0 upgraded, 0 newly installed, 0 to remove")
+    else:
+        delay()
+    return 0
+
+
+def dpkg(args: list[str]) -> int:
+    # the fake .deb files are text, naming the package they contain
+    if args[0] == "-i":
+        with open(args[1], "r") as fp:
+            package = fp.readline().split(":", maxsplit=1)[1].strip()
+        with state("apt") as installed:
+            installed[package] = "1.0"
+        delay(1)
+    return 0
+
+
+def dpkg_query(args: list[str]) -> int:
+    delay()
+    with state("apt") as installed:
+        for package, version in sorted(installed.items()):
+            print(f"{package}\tinstall ok installed\t{version}")
+    return 0
+
+
+def snap(args: list[str]) -> int:
+    with state("snap") as installed:
+        if args[0] == "list":
+            delay()
+            print("Name  Version  Rev  Tracking  Publisher  Notes")
+            for package, version in sorted(installed.items()):
+                print(f"{package}  {version}  1  latest/stable  -  -")
+        elif args[0] == "install":
+            package = next(arg for arg in args[1:] if not arg.startswith("-"))
+            delay(package not in installed)
+            installed[package] = "1.0"
+        elif args[0] == "refresh":
+            delay()
+            print("All snaps up to date.")
+    return 0
+
+
+def pipx(args: list[str]) -> int:
+    with state("pipx") as venvs:
+        if args[0] == "list":
+            delay()
+            data = {
+                name: {
+                    "metadata": {
+                        "main_package": {
+                            "package": name,
+                            "package_version": venv["version"],
+                            "package_or_url": name,
+                        }
+                    }
+                }
+                for name, venv in venvs.items()
+            }
+            print(json.dumps({"venvs": data}))
+        elif args[0] == "runpip":
+            # index versions
+            delay()
+            print(f"{args[-1]} ({venvs[args[1]]['latest']})")
+        elif args[0] == "upgrade":
+            venv = venvs[args[1]]
+            if venv["version"] == venv["latest"]:
+                delay()
+                print(f"{args[1]} is already at latest version")
+            else:
+                delay(1)
+                print(
+                    f"upgraded package {args[1]} from {venv['version']}"
+                    f" to {venv['latest']} (location: {STATE_DIR})"
+                )
+                venv["version"] = venv["latest"]
+    return 0
+
+
+def uv(args: list[str]) -> int:
+    with state("uv") as tools:
+        if args[:2] == ["self", "update"]:
+            delay()
+            print("success: You're on the latest version of uv", file=sys.stderr)
+        elif args[:2] == ["tool", "list"]:
+            delay()
+            outdated = "--outdated" in args
+            for name, tool in sorted(tools.items()):
+                if not outdated:
+                    print(f"{name} v{tool['version']}")
+                elif tool["version"] != tool["latest"]:
+                    print(f"{name} v{tool['version']} [latest: {tool['latest']}]")
+                print(f"- {name}")
+        elif args[:2] == ["tool", "upgrade"]:
+            tool = tools[args[2]]
+            if tool["version"] == tool["latest"]:
+                delay()
+                print("Nothing to upgrade", file=sys.stderr)
+            else:
+                delay(1)
+                print(
+                    f"Updated {args[2]} v{tool['version']} -> v{tool['latest']}",
+                    file=sys.stderr,
+                )
+                tool["version"] = tool["latest"]
+        elif args[:2] == ["tool", "install"]:
+            name, _, version = args[-1].partition("==")
+            delay(1)
+            tools[name] = {"version": version or "1.0", "latest": "1.0"}
+        elif args[:2] == ["cache", "size"]:
+            delay()
+            print(0)
+        elif args[:2] == ["cache", "dir"]:
+            delay()
+            cache = os.path.join(STATE_DIR, "uv-cache")
+            os.makedirs(cache, exist_ok=True)
+            print(cache)
+        else:
+            # cache prune and clean
+            delay()
+    return 0
+
+
+def git(args: list[str]) -> int:
+    delay()
+    if args and args[0] == "--version":
+        print("git version 2.45.0")
+    return 0
+
+
+def other(args: list[str]) -> int:
+    delay()
+    return 0
+
+
+TOOLS = {
+    "sudo": sudo,
+    "apt-get": apt_get,
+    "dpkg": dpkg,
+    "dpkg-query": dpkg_query,
+    "snap": snap,
+    "pipx": pipx,
+    "uv": uv,
+    "git": git,
+}
+
+
+if __name__ == "__main__":
+    tool = os.path.basename(sys.argv[0])
+    sys.exit(TOOLS.get(tool, other)(sys.argv[1:]))
@@ -0,0 +1,166 @@
+import argparse
+import copy
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from stats import percentile
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+THEME = os.path.join(os.path.dirname(THIS_DIR), "oh-my-posh", "nathanv-me.omp.json")
+
+
+def segment_types(theme: dict) -> list[str]:
+    """
+    Every type of segment in a theme, in the order they first appear.
+    """
+    types: list[str] = []
+    for block in theme["blocks"]:
+        for segment in block["segments"]:
+            if segment["type"] not in types:
+                types.append(segment["type"])
+    return types
+
+
+def without(theme: dict, types: list[str]) -> dict:
+    """
+    A copy of a theme with every segment of the given types removed.
+    """
+    variant = copy.deepcopy(theme)
+    for block in variant["blocks"]:
+        block["segments"] = [s for s in block["segments"] if s["type"] not in types]
+    return variant
+
+
+def write_variants(theme: dict, directory: str) -> dict[str, str]:
+    """
+    Write the full theme, one variant without each type of segment, and one
+    without any, so the cost of each segment is the difference between the
+    full theme and the variant without it.
+    """
+    types = segment_types(theme)
+    variants = {"full": theme, "none": without(theme, types)}
+    for type_ in types:
+        variants[f"-{type_}"] = without(theme, [type_])
+
+    paths = {}
+    for name, variant in variants.items():
+        path = os.path.join(directory, f"{name.strip('-')}.omp.json")
+        with open(path, "w") as fp:
+            json.dump(variant, fp)
+        paths[name] = path
+    return paths
+
+
+def render(omp: str, config: str, pwd: str) -> float:
+    """
+    Render the prompt once and return how long it took, in milliseconds.
+    """
+    start = time.perf_counter()
+    subprocess.run(
+        [
+            omp,
+            "print",
+            "primary",
+            "--shell",
+            "bash",
+            "--config",
+            config,
+            "--pwd",
+            pwd,
+            "--execution-time",
+            "1500",
+        ],
+        cwd=pwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    return (time.perf_counter() - start) * 1000
+
+
+def main(pwd: str, theme_path: str, omp: str, runs: int, warmup: int) -> None:
+    with open(theme_path, "r") as fp:
+        theme = json.load(fp)
+
+    directory = tempfile.mkdtemp(prefix="dotfiles-prompt-")
+    try:
+        variants = write_variants(theme, directory)
+
+        for _ in range(warmup):
+            for config in variants.values():
+                render(omp, config, pwd)
+
+        # take turns, so anything that slows the machine down for a while
+        # affects every variant the same
+        samples: dict[str, list[float]] = {name: [] for name in variants}
+        for _ in range(runs):
+            for name, config in variants.items():
+                samples[name].append(render(omp, config, pwd))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    full = {p: percentile(samples["full"], p) for p in (50, 95)}
+    rows = []
+    for name, times in samples.items():
+        if not name.startswith("-"):
+            continue
+        p50, p95 = percentile(times, 50), percentile(times, 95)
+        rows.append((name[1:], full[50] - p50, full[95] - p95, p50, p95))
+
+    print(f"Prompt in {pwd}, {runs} renders per variant")
+    print(f"  full theme     p50 {full[50]:7.1f} ms   p95 {full[95]:7.1f} ms")
+    none = samples["none"]
+    print(
+        f"  no segments    p50 {percentile(none, 50):7.1f} ms"
+        f"   p95 {percentile(none, 95):7.1f} ms"
+    )
+    print()
+    print(f"  {'segment':<14} {'cost p50':>10} {'cost p95':>10}   without it")
+    for type_, cost50, cost95, p50, p95 in sorted(rows, key=lambda r: -r[1]):
+        print(
+            f"  {type_:<14} {cost50:7.1f} ms {cost95:7.1f} ms"
+            f"   p50 {p50:.1f} ms, p95 {p95:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find out which oh-my-posh segments make the prompt slow"
+    )
+    parser.add_argument(
+        "directory",
+        nargs="?",
+        default=os.getcwd(),
+        help="Directory to render the prompt in",
+    )
+    parser.add_argument("--theme", default=THEME, help="Theme to profile")
+    parser.add_argument(
+        "--oh-my-posh",
+        default=shutil.which("oh-my-posh"),
+        metavar="PATH",
+        help="oh-my-posh binary to use",
+    )
+    parser.add_argument(
+        "-n", "--runs", type=int, default=20, help="Renders per theme variant"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=2, help="Untimed renders per variant first"
+    )
+    args = parser.parse_args()
+
+    if not args.oh_my_posh:
+        sys.exit("oh-my-posh is not installed")
+
+    main(
+        os.path.abspath(args.directory),
+        args.theme,
+        args.oh_my_posh,
+        args.runs,
+        args.warmup,
+    )
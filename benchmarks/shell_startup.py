@@ -0,0 +1,268 @@
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from stats import percentile
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(THIS_DIR)
+LINUX_DIR = os.path.join(REPO_DIR, "linux")
+OMP_DIR = os.path.join(REPO_DIR, "oh-my-posh")
+
+# fail when the p95 startup time of any mode is above this
+BUDGET_MS = 150
+
+# shells started as a terminal or tmux pane would, and as a new login would
+MODES = {
+    "interactive": ["bash", "-ic", "exit"],
+    "login": ["bash", "-lic", "exit"],
+}
+# the file each mode starts from, for tracing
+MODE_RC = {"interactive": "~/.bashrc", "login": "~/.bash_profile"}
+
+# stand-ins for programs that are not installed here, or need the network
+STUBS = {
+    "oh-my-posh": """#!/bin/sh
+echo "PS1='\\$ '"
+""",
+    "fnm": """#!/bin/sh
+echo 'export FNM_MULTISHELL_PATH="$HOME/.local/state/fnm_multishells/$$"'
+echo 'export PATH="$FNM_MULTISHELL_PATH/bin:$PATH"'
+""",
+}
+
+# xtrace prefix with the time each line starts at
+PS4 = "+${EPOCHREALTIME} ${BASH_SOURCE[0]:-?}:${LINENO} "
+TRACE_RE = re.compile(r"^\++(\d+\.\d+) (\S+):(\d+) ")
+
+
+def make_home() -> tuple[str, dict[str, str]]:
+    """
+    Create a throwaway home directory with the dotfiles installed and stub
+    binaries on the PATH. Returns it and the environment to run shells with.
+    """
+    home = tempfile.mkdtemp(prefix="dotfiles-shell-")
+
+    for file in os.listdir(LINUX_DIR):
+        if file.startswith("."):
+            os.symlink(os.path.join(LINUX_DIR, file), os.path.join(home, file))
+
+    themes = os.path.join(home, ".poshthemes")
+    os.makedirs(themes)
+    shutil.copy(os.path.join(OMP_DIR, "nathanv-me.omp.json"), themes)
+
+    bin_dir = os.path.join(home, ".local", "bin")
+    os.makedirs(bin_dir)
+    for name, script in STUBS.items():
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as fp:
+            fp.write(script)
+        os.chmod(path, 0o755)
+
+    env = {
+        "HOME": home,
+        "PATH": os.pathsep.join([bin_dir, "/usr/local/bin", "/usr/bin", "/bin"]),
+        "TERM": os.environ.get("TERM", "xterm-256color"),
+        "LANG": os.environ.get("LANG", "C.UTF-8"),
+        "USER": os.environ.get("USER", "user"),
+    }
+
+    # the lazy loading stubs install.py generates, for the tools in this home
+    subprocess.run(
+        [sys.executable, "-c", "import shell_init; shell_init.build_lazy_init()"],
+        env=env,
+        cwd=REPO_DIR,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    return home, env
+
+
+def clear_cache(home: str) -> None:
+    """
+    Remove the cached shell init output, so the next shell regenerates it.
+    The lazy loading stubs are kept, as install.py generates them.
+    """
+    directory = os.path.join(home, ".cache", "dotfiles", "shell-init")
+    for file in os.listdir(directory):
+        if file != "lazy.sh":
+            os.remove(os.path.join(directory, file))
+
+
+def time_shell(command: list[str], env: dict[str, str]) -> float:
+    """
+    Start a shell and return how long it took to exit, in milliseconds.
+    """
+    start = time.perf_counter()
+    subprocess.run(
+        command,
+        env=env,
+        cwd=env["HOME"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    return (time.perf_counter() - start) * 1000
+
+
+def trace_shell(mode: str, home: str, env: dict[str, str]) -> list[tuple]:
+    """
+    Start a shell with xtrace on and return (file, line, milliseconds) for
+    each line it ran. The trace is set up in an rcfile, since bash does not
+    take PS4 from the environment when running as root.
+    """
+    trace = os.path.join(home, "trace")
+    rcfile = os.path.join(home, "trace.rc")
+    with open(rcfile, "w") as fp:
+        fp.write(
+            f"PS4='{PS4}'\n"
+            f"exec 9> {trace}\n"
+            "BASH_XTRACEFD=9\n"
+            "set -x\n"
+            f". {MODE_RC[mode]}\n"
+            "set +x\n"
+        )
+
+    subprocess.run(
+        ["bash", "--rcfile", rcfile, "-ic", "exit"],
+        env=env,
+        cwd=home,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+
+    events = []
+    with open(trace, "r", errors="replace") as fp:
+        for line in fp:
+            if match := TRACE_RE.match(line):
+                start, file, lineno = match.groups()
+                events.append((float(start), file, int(lineno)))
+
+    # each line lasts until the next one starts
+    return [
+        (file, lineno, (events[i + 1][0] - start) * 1000)
+        for i, (start, file, lineno) in enumerate(events[:-1])
+        # lines of the tracing rcfile itself
+        if file != rcfile
+    ]
+
+
+def source_line(file: str, lineno: int) -> str:
+    """
+    The text of a traced line, for the report.
+    """
+    try:
+        with open(file, "r", errors="replace") as fp:
+            for i, line in enumerate(fp, start=1):
+                if i == lineno:
+                    return line.strip()
+    except OSError:
+        pass
+    return ""
+
+
+def short_path(file: str, home: str) -> str:
+    """
+    Path relative to the throwaway home directory, for the report.
+    """
+    return file.replace(home, "~")
+
+
+def main(runs: int, warmup: int, budget: float, top: int, cold: bool) -> int:
+    home, env = make_home()
+    over_budget = []
+
+    try:
+        for mode, command in MODES.items():
+            for _ in range(warmup):
+                time_shell(command, env)
+
+            samples = []
+            for _ in range(runs):
+                if cold:
+                    clear_cache(home)
+                samples.append(time_shell(command, env))
+
+            p50 = percentile(samples, 50)
+            p95 = percentile(samples, 95)
+            print(
+                f"{mode:<12} p50 {p50:7.1f} ms   p95 {p95:7.1f} ms"
+                f"   min {min(samples):7.1f} ms   ({runs} runs)"
+            )
+            if p95 > budget:
+                over_budget.append(mode)
+
+        for mode in MODES:
+            by_line: dict[tuple, list[float]] = defaultdict(list)
+            by_file: dict[str, float] = defaultdict(float)
+
+            traces = max(runs // 4, 1)
+            for _ in range(traces):
+                if cold:
+                    clear_cache(home)
+                for file, lineno, ms in trace_shell(mode, home, env):
+                    by_line[(file, lineno)].append(ms)
+                    by_file[file] += ms
+
+            print(f"\n{mode} breakdown (mean of {traces} traced runs)")
+            for file, total in sorted(by_file.items(), key=lambda i: -i[1]):
+                print(f"  {total / traces:7.2f} ms  {short_path(file, home)}")
+
+            print(f"\n{mode} slowest lines")
+            ranked = sorted(by_line.items(), key=lambda i: -sum(i[1]))[:top]
+            for (file, lineno), times in ranked:
+                location = f"{short_path(file, home)}:{lineno}"
+                print(
+                    f"  {sum(times) / traces:7.2f} ms  {location:<40}"
+                    f" {source_line(file, lineno)[:60]}"
+                )
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    if over_budget:
+        print(f"\np95 startup of {', '.join(over_budget)} is over {budget:.0f} ms")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure how long bash takes to start with these dotfiles"
+    )
+    parser.add_argument(
+        "-n", "--runs", type=int, default=40, help="Shells to start per mode"
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=3,
+        help="Untimed shells to start first, which also build the init cache",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=BUDGET_MS,
+        metavar="MS",
+        help="Exit with an error if the p95 startup time is over this",
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="Number of slowest lines to show"
+    )
+    parser.add_argument(
+        "--cold",
+        action="store_true",
+        help="Clear the shell init cache before every shell",
+    )
+    args = parser.parse_args()
+
+    sys.exit(main(args.runs, args.warmup, args.budget, args.top, args.cold))
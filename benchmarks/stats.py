@@ -0,0 +1,14 @@
+"""
+Helpers shared by the benchmark scripts.
+"""
+
+import statistics
+
+
+def percentile(samples: list[float], percent: int) -> float:
+    """
+    The given percentile of some timings.
+    """
+    if len(samples) < 2:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method="inclusive")[percent - 1]
@@ -0,0 +1,541 @@
+import argparse
+import contextlib
+import functools
+import http.server
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from collections.abc import Callable
+
+from stats import percentile
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(THIS_DIR)
+LINUX_DIR = os.path.join(REPO_DIR, "linux")
+BASELINE_FILE = os.path.join(THIS_DIR, "baseline.json")
+
+# fail when a benchmark is this much slower than its baseline
+THRESHOLD = 0.25
+
+# tools replaced by benchmarks/fake_tools.py
+FAKE_TOOLS = [
+    "sudo",
+    "apt-get",
+    "dpkg",
+    "dpkg-query",
+    "snap",
+    "pipx",
+    "uv",
+    "git",
+    "add-apt-repository",
+    "fc-cache",
+]
+
+# the only real tools on the PATH, so nothing else installed on the machine
+# is found and run
+REAL_TOOLS = [
+    "bash",
+    "sh",
+    "env",
+    "cat",
+    "chmod",
+    "cp",
+    "ln",
+    "ls",
+    "mkdir",
+    "mv",
+    "rm",
+    "grep",
+    "sed",
+    "head",
+    "tail",
+    "sort",
+    "tr",
+    "dirname",
+    "basename",
+    "id",
+    "uname",
+    "tty",
+    "tput",
+    "dircolors",
+    "lesspipe",
+    "nice",
+    "ionice",
+    "sleep",
+]
+
+# files served in place of the ones install.py downloads, by the setting that
+# holds their URL
+ARTIFACTS = {
+    "UV_INSTALL_URL": "uv-install.sh",
+    "DOCKER_INSTALL_URL": "get-docker.sh",
+    "CHROME_DEB_URL": "google-chrome-stable_current_amd64.deb",
+    "STEAM_DEB_URL": "steam.deb",
+    "SSH_KEY_URL": "ssh.pub",
+    "FONTS_ZIP_URL": "CascadiaCode.zip",
+    "OMP_INSTALL_URL": "omp-install.sh",
+}
+
+# tools installed with pipx, and whether they have an update
+PIPX_VENVS = {
+    "black": True,
+    "ruff": True,
+    "httpie": False,
+    "poetry": True,
+    "pre-commit": False,
+    "tox": True,
+    "twine": False,
+    "yt-dlp": True,
+}
+
+# tools installed with uv, and whether they have an update
+UV_TOOLS = {
+    "hatch": True,
+    "mypy": False,
+    "nox": True,
+    "pyright": False,
+}
+
+# run in a fresh interpreter inside the throwaway home, since the scripts read
+# where home is when they are imported
+INSTALL_DRIVER = """
+import builtins, json, sys
+sys.path.insert(0, sys.argv[1])
+# yes to everything, but GPG needs a real gpg
+builtins.input = lambda prompt="": "n" if "GPG" in prompt else "y"
+import install
+for name, url in json.loads(sys.argv[2]).items():
+    setattr(install, name, url)
+install.main(jobs=int(sys.argv[3]))
+"""
+
+UPDATE_DRIVER = """
+import os, sys
+sys.path.insert(0, sys.argv[1])
+import update
+update.APT_LISTS_DIR = os.path.join(os.environ["HOME"], "apt-lists")
+sys.exit(update.main(jobs=int(sys.argv[3])))
+"""
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves the artifacts, and answers Nexus API calls as if every repository
+    already existed.
+    """
+
+    def do_GET(self) -> None:
+        if self.path.startswith("/service/rest/"):
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        super().do_GET()
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def make_artifacts(directory: str) -> None:
+    """
+    Create harmless files of realistic sizes to serve in place of the real
+    downloads.
+    """
+    for name in ("uv-install.sh", "get-docker.sh", "omp-install.sh"):
+        with open(os.path.join(directory, name), "w") as fp:
+            fp.write("#!/bin/sh\nexit 0\n")
+
+    # the fake dpkg reads the package name from the first line
+    debs = {
+        "google-chrome-stable_current_amd64.deb": ("google-chrome-stable", 8),
+        "steam.deb": ("steam-launcher", 4),
+    }
+    for name, (package, megabytes) in debs.items():
+        with open(os.path.join(directory, name), "w") as fp:
+            fp.write(f"Package: {package}\n")
+            fp.write("x" * megabytes * 1024 * 1024)
+
+    with open(os.path.join(directory, "ssh.pub"), "w") as fp:
+        for i in range(3):
+            fp.write(f"ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAI{i:040d} key{i}\n")
+
+    with zipfile.ZipFile(os.path.join(directory, "CascadiaCode.zip"), "w") as zf:
+        for style in ("Regular", "Bold", "Italic"):
+            zf.writestr(
+                f"CaskaydiaCoveNerdFont-{style}.ttf", os.urandom(2 * 1024 * 1024)
+            )
+
+
+@contextlib.contextmanager
+def serve(directory: str):
+    """
+    Serve a directory over HTTP on a free local port, yielding its URL.
+    """
+    handler = functools.partial(Handler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def make_home(root: str, latency: float) -> dict[str, str]:
+    """
+    Create a throwaway home with the fake tools on the PATH, returning the
+    environment to run the scripts with.
+    """
+    home = tempfile.mkdtemp(prefix="home-", dir=root)
+    bin_dir = os.path.join(home, "fake-bin")
+    real_bin_dir = os.path.join(home, "real-bin")
+    fake_state = os.path.join(home, "fake-state")
+    os.makedirs(bin_dir)
+    os.makedirs(real_bin_dir)
+    os.makedirs(fake_state)
+
+    fake = os.path.join(bin_dir, "fake_tools.py")
+    with open(os.path.join(THIS_DIR, "fake_tools.py"), "r") as src:
+        source = src.read()
+    with open(fake, "w") as fp:
+        fp.write(f"#!{sys.executable} -S\n{source}")
+    os.chmod(fake, 0o755)
+    for tool in FAKE_TOOLS:
+        os.symlink(fake, os.path.join(bin_dir, tool))
+
+    for tool in REAL_TOOLS:
+        if path := shutil.which(tool):
+            os.symlink(path, os.path.join(real_bin_dir, tool))
+
+    for name, tools in (("pipx", PIPX_VENVS), ("uv", UV_TOOLS)):
+        with open(os.path.join(fake_state, f"{name}.json"), "w") as fp:
+            json.dump(
+                {
+                    tool: {"version": "1.0", "latest": "1.1" if outdated else "1.0"}
+                    for tool, outdated in tools.items()
+                },
+                fp,
+            )
+
+    return {
+        "HOME": home,
+        "PATH": os.pathsep.join([bin_dir, real_bin_dir]),
+        "LANG": os.environ.get("LANG", "C.UTF-8"),
+        "USER": os.environ.get("USER", "user"),
+        "FAKE_STATE": fake_state,
+        "FAKE_LATENCY_MS": str(latency),
+    }
+
+
+def run_script(
+    driver: str, env: dict[str, str], urls: dict[str, str], jobs: int
+) -> float:
+    """
+    Run install.py or update.py through a driver and return how long it
+    took, in milliseconds.
+    """
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-c", driver, REPO_DIR, json.dumps(urls), str(jobs)],
+        env=env,
+        cwd=env["HOME"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    elapsed = (time.perf_counter() - start) * 1000
+
+    if process.returncode != 0:
+        print(process.stdout[-3000:])
+        raise RuntimeError(f"Run failed with exit code {process.returncode}")
+    return elapsed
+
+
+def end_to_end(runs: int, latency: float, jobs: int) -> dict[str, list[float]]:
+    """
+    Run both scripts in fresh homes, then again in the same homes, where
+    there is nothing left to do.
+    """
+    samples: dict[str, list[float]] = {}
+    root = tempfile.mkdtemp(prefix="dotfiles-bench-")
+
+    try:
+        artifacts = os.path.join(root, "artifacts")
+        os.makedirs(artifacts)
+        make_artifacts(artifacts)
+
+        with serve(artifacts) as url:
+            urls = {name: f"{url}/{file}" for name, file in ARTIFACTS.items()}
+
+            scripts = {"update": UPDATE_DRIVER}
+            if os.geteuid() == 0:
+                print("Skipping install end to end, install.py refuses to run as root")
+            else:
+                scripts["install"] = INSTALL_DRIVER
+
+            for script, driver in scripts.items():
+                for _ in range(runs):
+                    env = make_home(root, latency)
+                    for run in ("cold", "warm"):
+                        samples.setdefault(f"{script} {run}", []).append(
+                            run_script(driver, env, urls, jobs)
+                        )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    return samples
+
+
+def apt_lines(count: int) -> list[str]:
+    """
+    A large apt sources file, with comments and options in brackets like real
+    ones have.
+    """
+    lines = []
+    for i in range(count):
+        host = f"http://mirror{i % 50}.example.com/ubuntu/"
+        if i % 10 == 0:
+            lines.append(f"# deb {host} jammy-backports main")
+        elif i % 10 == 1:
+            lines.append("")
+        elif i % 3 == 0:
+            lines.append(
+                f"deb [arch=amd64 signed-by=/usr/share/keyrings/repo{i % 50}.gpg]"
+                f" {host} jammy{i % 3} main restricted universe multiverse"
+            )
+        else:
+            lines.append(f"deb-src {host} jammy{i % 3} main restricted")
+    return lines
+
+
+def measure(
+    runs: int, func: Callable[[], None], setup: Callable[[], None] = lambda: None
+) -> list[float]:
+    """
+    Time a function some number of times, in milliseconds, running the setup
+    untimed before each one.
+    """
+    samples = []
+    for _ in range(runs):
+        setup()
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def micro(runs: int) -> dict[str, list[float]]:
+    """
+    Time the functions that run once per line of a file on large files.
+    """
+    samples = {}
+    root = tempfile.mkdtemp(prefix="dotfiles-bench-")
+    lines = apt_lines(20000)
+
+    try:
+        with serve(root) as url:
+            os.environ.setdefault("NEXUS_USERNAME", "benchmark")
+            os.environ.setdefault("NEXUS_PASSWORD", "benchmark")
+            sys.path.insert(0, LINUX_DIR)
+            import rewrite_apt_sources
+
+            rewrite_apt_sources.NEXUS_URL = url
+            quiet = contextlib.redirect_stdout(io.StringIO())
+
+            def split_all() -> None:
+                for line in lines:
+                    rewrite_apt_sources.split_string(line)
+
+            def process_all() -> None:
+                with quiet:
+                    for line in lines:
+                        rewrite_apt_sources.process_line(line)
+
+            samples["split_string"] = measure(runs, split_all)
+            # the first pass looks up every repo in Nexus, later ones use the
+            # cache, which is what is measured
+            process_all()
+            samples["process_line"] = measure(runs, process_all)
+
+            sources = rewrite_apt_sources.pathlib.Path(root, "sources.list")
+
+            def reset_sources() -> None:
+                with open(sources, "w") as fp:
+                    fp.writelines(f"{line}\n" for line in lines)
+                backup = sources.with_name("sources.list.orig")
+                if backup.exists():
+                    backup.unlink()
+
+            def process_file() -> None:
+                with quiet:
+                    rewrite_apt_sources.process_file(sources)
+
+            samples["process_file"] = measure(runs, process_file, reset_sources)
+
+        if os.geteuid() == 0:
+            print("Skipping add_line_to_file, install.py refuses to run as root")
+            return samples
+
+        sys.path.insert(0, REPO_DIR)
+        import install
+
+        profile = os.path.join(root, ".bashrc")
+        exports = [f"export VAR{i}=value{i}" for i in range(20000)]
+
+        def reset_profile() -> None:
+            with open(profile, "w") as fp:
+                fp.writelines(f"{line}\n" for line in exports)
+
+        def add_lines() -> None:
+            for i in range(0, 20000, 400):
+                # replace an existing line, then add a new one
+                install.add_line_to_file(profile, f"export VAR{i}=changed")
+                install.add_line_to_file(profile, f"alias a{i}=b", True)
+
+        samples["add_line_to_file"] = measure(runs, add_lines, reset_profile)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    return samples
+
+
+def main(
+    runs: int,
+    e2e_runs: int,
+    latency: float,
+    jobs: int,
+    only: None | str,
+    baseline_file: str,
+    threshold: float,
+    save: bool,
+) -> int:
+    samples = {}
+    if only != "e2e":
+        samples.update(micro(runs))
+    e2e = {}
+    if only != "micro":
+        e2e = end_to_end(e2e_runs, latency, jobs)
+        samples.update(e2e)
+
+    try:
+        with open(baseline_file, "r") as fp:
+            baseline = json.load(fp)
+    except FileNotFoundError:
+        baseline = {"latency_ms": latency, "results": {}}
+
+    # end to end timings mostly depend on the simulated latency
+    comparable = {
+        name
+        for name in baseline["results"]
+        if name in samples and (name not in e2e or baseline["latency_ms"] == latency)
+    }
+
+    regressions = []
+    print(f"{'benchmark':<18} {'p50':>10} {'p95':>10} {'baseline':>10}  change")
+    for name, times in samples.items():
+        p50 = percentile(times, 50)
+        line = f"{name:<18} {p50:7.1f} ms {percentile(times, 95):7.1f} ms"
+        if name in comparable:
+            base = baseline["results"][name]
+            change = p50 / base - 1
+            line += f" {base:7.1f} ms  {change:+6.1%}"
+            if change > threshold:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+
+    if save:
+        results = {
+            name: round(percentile(times, 50), 1) for name, times in samples.items()
+        }
+        if baseline["latency_ms"] == latency:
+            # keep baselines of benchmarks that did not run this time
+            results = {**baseline["results"], **results}
+        with open(baseline_file, "w") as fp:
+            json.dump({"latency_ms": latency, "results": results}, fp, indent=2)
+            fp.write("\n")
+        print(f"\nSaved baseline to {baseline_file}")
+
+    if regressions:
+        print(
+            f"\n{', '.join(regressions)} got more than {threshold:.0%} slower"
+            " than the baseline"
+        )
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark install.py and update.py offline, with fake"
+        " package managers and a local server for downloads"
+    )
+    parser.add_argument(
+        "-n", "--runs", type=int, default=10, help="Runs of each microbenchmark"
+    )
+    parser.add_argument(
+        "--e2e-runs",
+        type=int,
+        default=3,
+        help="End to end runs of each script, each in a fresh home",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=20,
+        metavar="MS",
+        help="How long every call to a fake tool takes, and again per package",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=4, help="Steps the scripts run at once"
+    )
+    parser.add_argument(
+        "--only", choices=["micro", "e2e"], help="Only run one kind of benchmark"
+    )
+    parser.add_argument(
+        "--baseline",
+        default=BASELINE_FILE,
+        metavar="PATH",
+        help="Baseline timings to compare against",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=THRESHOLD,
+        help="Fail when a p50 is this fraction slower than its baseline",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Save these timings as the new baseline",
+    )
+    args = parser.parse_args()
+
+    sys.exit(
+        main(
+            args.runs,
+            args.e2e_runs,
+            args.latency,
+            args.jobs,
+            args.only,
+            args.baseline,
+            args.threshold,
+            args.save_baseline,
+        )
+    )
@@ -0,0 +1,396 @@
+import hashlib
+import http.client
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+import tracing
+from scheduler import resource
+from utils import cache_dir, write_json
+
+# can be pointed at a directory shared by several machines
+CACHE_DIR = os.environ.get("DOTFILES_CACHE_DIR") or os.path.join(
+    cache_dir(), "downloads"
+)
+# least recently used files are evicted above this size
+CACHE_MAX_BYTES = int(os.environ.get("DOTFILES_CACHE_MAX_MB", 2048)) * 1024 * 1024
+
+CHUNK_SIZE = 1024 * 1024
+# seconds to wait on a stalled connection
+TIMEOUT = 30
+# failed downloads are retried after 1, 2, 4... seconds
+RETRIES = 5
+BACKOFF = 1
+# seconds between progress updates
+PROGRESS_INTERVAL = 2
+
+# background downloads started ahead of time
+_PREFETCH_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch")
+_PREFETCHED: dict[str, Future] = {}
+_PREFETCHED_LOCK = threading.Lock()
+
+# when installing from a bundle, the local file for each URL
+OFFLINE: None | dict[str, str] = None
+
+
+def _url_entry_path(url: str) -> str:
+    """
+    Path of the metadata file for a URL.
+    """
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, "urls", f"{key}.json")
+
+
+def _blob_path(sha256: str) -> str:
+    """
+    Path of a file in the cache by its content hash.
+    """
+    return os.path.join(CACHE_DIR, "blobs", sha256)
+
+
+def _read_entry(url: str) -> None | dict:
+    """
+    Read the cache entry for a URL, if there is a usable one.
+    """
+    try:
+        with open(_url_entry_path(url), "r") as fp:
+            entry = json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+    blob = _blob_path(entry["sha256"])
+    if not os.path.isfile(blob) or os.path.getsize(blob) != entry["size"]:
+        return None
+
+    return entry
+
+
+def evict(keep: None | str = None) -> None:
+    """
+    Remove the least recently used files until the cache fits in the size cap.
+    The file given to keep is never removed.
+    """
+    blobs_dir = os.path.dirname(_blob_path(""))
+    if not os.path.isdir(blobs_dir):
+        return
+
+    blobs = []
+    for entry in os.scandir(blobs_dir):
+        if entry.path == keep or entry.name.endswith(".part"):
+            continue
+
+        if entry.is_file():
+            stat = entry.stat()
+            blobs.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in blobs)
+    if keep:
+        total += os.path.getsize(keep)
+
+    for _, size, path in sorted(blobs):
+        if total <= CACHE_MAX_BYTES:
+            break
+
+        print(f"Evicting {path} from the download cache")
+        os.remove(path)
+        total -= size
+
+
+def _partial_path(url: str) -> str:
+    """
+    Path of the partially downloaded file for a URL. Each machine keeps its
+    own, in case the cache is shared.
+    """
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, "partial", f"{key}.{socket.gethostname()}")
+
+
+def _read_partial(url: str) -> None | dict:
+    """
+    Read the state of a partial download that can be resumed.
+    """
+    path = _partial_path(url)
+    try:
+        with open(f"{path}.json", "r") as fp:
+            partial = json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+    # resuming is only safe if the server can tell us the file has not changed
+    if not (partial.get("etag") or partial.get("last_modified")):
+        return None
+    if not os.path.isfile(path) or os.path.getsize(path) < partial["done"]:
+        return None
+
+    return partial
+
+
+def _remove_partial(url: str) -> None:
+    """
+    Forget a partial download.
+    """
+    path = _partial_path(url)
+    for file in (path, f"{path}.json"):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def _format_size(size: float) -> str:
+    """
+    Human readable size in megabytes.
+    """
+    return f"{size / 1024 / 1024:.1f} MB"
+
+
+def _stream(
+    url: str, response: http.client.HTTPResponse, partial: dict
+) -> tuple[str, int]:
+    """
+    Stream a response body into the partial file for a URL, hashing it on
+    the way, then move it into the cache. Returns its hash and size.
+    """
+    path = _partial_path(url)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    digest = hashlib.sha256()
+
+    with open(path, "r+b" if partial["done"] else "w+b") as fp:
+        # hash what was already downloaded by an earlier attempt
+        while fp.tell() < partial["done"]:
+            digest.update(fp.read(min(CHUNK_SIZE, partial["done"] - fp.tell())))
+
+        if partial["size"] and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fp.fileno(), 0, partial["size"])
+
+        start = time.monotonic()
+        started_at = partial["done"]
+        last_report = start
+
+        try:
+            while chunk := response.read(CHUNK_SIZE):
+                fp.write(chunk)
+                digest.update(chunk)
+                partial["done"] += len(chunk)
+
+                metrics.add("download_bytes_total", len(chunk))
+
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    rate = (partial["done"] - started_at) / (now - start)
+                    total = (
+                        f"/{_format_size(partial['size'])}" if partial["size"] else ""
+                    )
+                    print(
+                        f"\t{url}: {_format_size(partial['done'])}{total}"
+                        f" ({_format_size(rate)}/s)"
+                    )
+                    write_json(f"{path}.json", partial)
+        finally:
+            fp.flush()
+            write_json(f"{path}.json", partial)
+
+        if partial["size"] and partial["done"] != partial["size"]:
+            raise http.client.IncompleteRead(b"", partial["size"] - partial["done"])
+
+        # drop any space preallocated beyond what was received
+        fp.truncate(partial["done"])
+
+    elapsed = max(time.monotonic() - start, 0.001)
+    rate = (partial["done"] - started_at) / elapsed
+    print(
+        f"Downloaded {url} ({_format_size(partial['done'])} in {elapsed:.1f}s,"
+        f" {_format_size(rate)}/s)"
+    )
+
+    sha256 = digest.hexdigest()
+    blob = _blob_path(sha256)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    # readable by everyone, in case the cache is shared
+    os.chmod(path, 0o644)
+    os.replace(path, blob)
+    os.remove(f"{path}.json")
+
+    return sha256, partial["done"]
+
+
+def _download(url: str, entry: None | dict) -> None | dict:
+    """
+    Make one attempt at downloading a URL, resuming a partial download if
+    there is one. Returns the new cache entry, or None if the cached entry is
+    still current.
+    """
+    partial = _read_partial(url)
+
+    headers = {}
+    if partial:
+        headers["Range"] = f"bytes={partial['done']}-"
+        headers["If-Range"] = partial["etag"] or partial["last_modified"]
+    elif entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    request = urllib.request.Request(url, headers=headers)
+
+    try:
+        with resource("network"), tracing.span(
+            f"GET {os.path.basename(url)}", "http", url=url, resume=bool(partial)
+        ), urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            length = response.headers.get("Content-Length")
+
+            if partial and response.status == 206:
+                print(f"Resuming {url} from {_format_size(partial['done'])}")
+            else:
+                print(f"Downloading {url}")
+                partial = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "done": 0,
+                }
+
+            partial["size"] = partial["done"] + int(length) if length else None
+            sha256, size = _stream(url, response, partial)
+
+            return {
+                "url": url,
+                "etag": partial["etag"],
+                "last_modified": partial["last_modified"],
+                "sha256": sha256,
+                "size": size,
+            }
+
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and entry:
+            return None
+        if e.code == 416 and partial:
+            # the partial file is no good, start over without it
+            print(f"Can not resume {url}, starting over")
+            _remove_partial(url)
+            return _download(url, entry)
+        raise
+
+
+def _fetch(url: str, sha256: None | str = None) -> str:
+    """
+    Download a URL into the cache, revalidating any cached copy. Failed
+    downloads are retried with exponential backoff.
+    """
+    with tracing.span(os.path.basename(url), "download", url=url):
+        entry = _read_entry(url)
+        if entry and sha256 and entry["sha256"] != sha256:
+            entry = None
+
+        for attempt in range(RETRIES):
+            try:
+                new_entry = _download(url, entry)
+                break
+            except urllib.error.HTTPError as e:
+                # only server errors are worth retrying
+                if (e.code < 500 and e.code != 429) or attempt == RETRIES - 1:
+                    raise
+                error = e
+            except (OSError, http.client.HTTPException) as e:
+                if entry:
+                    print(f"Could not reach {url} ({e}), using cached copy")
+                    new_entry = None
+                    break
+                if attempt == RETRIES - 1:
+                    raise
+                error = e
+
+            delay = BACKOFF * 2**attempt
+            print(f"Downloading {url} failed ({error}), retrying in {delay}s")
+            time.sleep(delay)
+
+        if new_entry:
+            if sha256 and new_entry["sha256"] != sha256:
+                raise ValueError(
+                    f"{url} has hash {new_entry['sha256']}, expected {sha256}"
+                )
+            entry = new_entry
+            write_json(_url_entry_path(url), entry)
+            metrics.add("download_cache_misses_total")
+        else:
+            print(f"Using cached {url}")
+            metrics.add("download_cache_hits_total")
+
+        blob = _blob_path(entry["sha256"])
+        # mark as recently used
+        os.utime(blob)
+        evict(keep=blob)
+
+        return blob
+
+
+def fetch(url: str, sha256: None | str = None) -> str:
+    """
+    Download a URL into the cache and return the path of the cached file.
+    Cached files are revalidated with the server, so only a conditional
+    request is made when nothing changed. If the URL is being prefetched,
+    that download is waited for instead. If a hash is given, the file must
+    match it. The returned file is shared with
+    other runs and must not be modified or removed.
+    """
+    if OFFLINE is not None:
+        if url not in OFFLINE:
+            raise FileNotFoundError(f"{url} is not in the bundle")
+        metrics.add("download_cache_hits_total")
+        return OFFLINE[url]
+
+    with _PREFETCHED_LOCK:
+        future = _PREFETCHED.get(url)
+
+    if future:
+        try:
+            with tracing.span(os.path.basename(url), "prefetch wait", url=url):
+                path = future.result()
+            # cached files are named by their hash
+            if not sha256 or os.path.basename(path) == sha256:
+                return path
+        except Exception as e:
+            print(f"Prefetching {url} failed ({e}), trying again")
+
+    return _fetch(url, sha256=sha256)
+
+
+def prefetch(urls: list[str]) -> None:
+    """
+    Start downloading URLs in the background, so they are already on disk
+    when they are needed.
+    """
+    if OFFLINE is not None:
+        return
+
+    with _PREFETCHED_LOCK:
+        for url in urls:
+            if url not in _PREFETCHED:
+                _PREFETCHED[url] = _PREFETCH_POOL.submit(_fetch, url)
+
+
+def cancel_prefetch() -> None:
+    """
+    Cancel prefetches that have not started yet.
+    """
+    with _PREFETCHED_LOCK:
+        for future in _PREFETCHED.values():
+            future.cancel()
+
+
+def fetch_copy(url: str, suffix: str = "") -> str:
+    """
+    Download a URL through the cache and return a private temporary copy,
+    which the caller is responsible for removing.
+    """
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    shutil.copyfile(fetch(url), path)
+    return path
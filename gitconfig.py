@@ -0,0 +1,154 @@
+import os
+import re
+
+from utils import atomic_write
+
+SECTION_RE = re.compile(r'^\s*\[\s*([A-Za-z0-9.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+VARIABLE_RE = re.compile(r"^\s*([A-Za-z][A-Za-z0-9-]*)\s*(?:=(.*))?$")
+
+
+def split_key(key: str) -> tuple[str, None | str, str]:
+    """
+    Split a key like color.status.added into its section, subsection and name.
+    Sections and names are case insensitive, subsections are not.
+    """
+    section, _, name = key.partition(".")
+    subsection = None
+    if "." in name:
+        subsection, _, name = name.rpartition(".")
+    return section.lower(), subsection, name.lower()
+
+
+def parse_value(raw: None | str) -> str:
+    """
+    Parse the value of a variable the way git does, handling quotes, escapes
+    and comments.
+    """
+    # a variable without a value is a boolean
+    if raw is None:
+        return "true"
+
+    value = ""
+    pending_space = ""
+    quoted = False
+    escapes = {"n": "\n", "t": "\t", "b": "\b", '"': '"', "\\": "\\"}
+
+    i = 0
+    while i < len(raw):
+        char = raw[i]
+        if char == "\\" and i + 1 < len(raw):
+            value += pending_space + escapes.get(raw[i + 1], raw[i + 1])
+            pending_space = ""
+            i += 2
+            continue
+
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char in "#;":
+            break
+        elif not quoted and char.isspace():
+            # only keep whitespace between words
+            if value:
+                pending_space += char
+        else:
+            value += pending_space + char
+            pending_space = ""
+
+        i += 1
+
+    return value
+
+
+def format_value(value: str) -> str:
+    """
+    Escape a value for writing, quoting it if needed.
+    """
+    escaped = (
+        value.replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+        .replace("\t", "\\t")
+    )
+    if value != value.strip() or "#" in value or ";" in value:
+        escaped = f'"{escaped}"'
+    return escaped
+
+
+def parse(lines: list[str]) -> tuple[dict, dict]:
+    """
+    Index a config file. Returns the line and value of the last occurrence of
+    each key, and the last line belonging to each section.
+    """
+    variables: dict[tuple, tuple[int, str]] = {}
+    sections: dict[tuple, int] = {}
+    section: None | tuple = None
+
+    for i, line in enumerate(lines):
+        if match := SECTION_RE.match(line):
+            name, subsection = match.groups()
+            if subsection is not None:
+                subsection = re.sub(r"\\(.)", r"\1", subsection)
+                section = (name.lower(), subsection)
+            elif "." in name:
+                # deprecated [section.subsection] syntax
+                name, _, subsection = name.partition(".")
+                section = (name.lower(), subsection.lower())
+            else:
+                section = (name.lower(), None)
+            sections[section] = i
+
+        elif section and (match := VARIABLE_RE.match(line)):
+            name, raw = match.groups()
+            variables[(*section, name.lower())] = (i, parse_value(raw))
+            sections[section] = i
+
+        elif section and line.strip() and not line.lstrip().startswith(("#", ";")):
+            sections[section] = i
+
+    return variables, sections
+
+
+def set_values(path: str, values: dict[str, str]) -> list[str]:
+    """
+    Set several config values in a git config file, reading it once and
+    writing it at most once. Returns the keys that were changed.
+    """
+    # edit the real file, in case it is a symlink
+    path = os.path.realpath(path)
+
+    if os.path.isfile(path):
+        with open(path, "r") as fp:
+            lines = fp.read().splitlines()
+    else:
+        lines = []
+
+    changed = []
+    for key, value in values.items():
+        variables, sections = parse(lines)
+        section, subsection, _ = split_key(key)
+        name = key.rpartition(".")[2]
+        new_line = f"\t{name} = {format_value(value)}"
+
+        existing = variables.get(split_key(key))
+        if existing:
+            if existing[1] == value:
+                continue
+            lines[existing[0]] = new_line
+        elif (section, subsection) in sections:
+            lines.insert(sections[(section, subsection)] + 1, new_line)
+        else:
+            if subsection is None:
+                lines.append(f"[{section}]")
+            else:
+                escaped = subsection.replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(f'[{section} "{escaped}"]')
+            lines.append(new_line)
+
+        changed.append(key)
+
+    if not changed:
+        return changed
+
+    atomic_write(path, "\n".join(lines) + "\n")
+
+    return changed
@@ -1,21 +1,69 @@
 import argparse
+import atexit
 import functools
 import getpass
+import hashlib
+import inspect
+import io
 import json
 import os
+import shlex
 import shutil
+import subprocess
 import sys
+import tarfile
 import tempfile
-import urllib.request
 import zipfile
 from collections.abc import Callable
 from typing import Any
 
-from utils import IS_LINUX, IS_WINDOWS, IS_WSL, run, which
+import downloads
+import gitconfig
+import metrics
+import shell_init
+import state
+import sync
+import tracing
+from scheduler import Step, resource, run_steps
+from utils import (
+    IS_LINUX,
+    IS_WINDOWS,
+    IS_WSL,
+    LineEditor,
+    cache_dir,
+    file_hash,
+    file_sha256,
+    run,
+    run_output,
+    which,
+)
 
 # our tracking
 APT_UPDATED = False
 UNATTENDED = False
+# apt packages waiting to be installed in one transaction
+APT_QUEUE: list[str] = []
+# queued apt packages to upgrade even if they are already installed
+APT_UPGRADE: set[str] = set()
+# installed package versions, each read once per run
+DPKG_INSTALLED: None | dict[str, str] = None
+SNAP_INSTALLED: None | dict[str, str] = None
+# download apt archives ourselves, in parallel
+APT_PARALLEL = False
+# mirrors to spread apt archive downloads over
+APT_MIRRORS: list[str] = []
+# repos to give the cheaper git prompt, besides any found by their size
+LARGE_GIT_REPOS: list[str] = []
+# directory of an unpacked bundle to install apt packages from
+APT_BUNDLE_DIR: None | str = None
+# when exporting a bundle, files are needed even if installed here
+EXPORTING = False
+# when planning, steps only ask their questions and do not run
+PLANNING = False
+# steps chosen while planning
+SELECTED: set[str] = set()
+# answers given to prompts, so every question is only asked once
+ANSWERS: dict[str, bool] = {}
 
 # directories
 HOME_DIR = os.path.expanduser("~")
@@ -26,9 +74,43 @@ OMP_DIR = os.path.join(THIS_DIR, "oh-my-posh")
 WINDOWS_DIR = os.path.join(THIS_DIR, "windows")
 LINUX_DIR = os.path.join(THIS_DIR, "linux")
 
+GITCONFIG = os.environ.get("GIT_CONFIG_GLOBAL") or os.path.join(HOME_DIR, ".gitconfig")
+GPG_AGENT_CONF = os.path.join(HOME_DIR, ".gnupg", "gpg-agent.conf")
+
 
 # our constants
 BREW_PATH = "/home/linuxbrew/.linuxbrew/bin/brew"
+FAVORITE_APT_PACKAGES = [
+    "python-is-python3",
+    "bat",
+    "neofetch",
+    "net-tools",
+    "iputils-ping",
+]
+# directories to look for large git repos in, one level deep
+GIT_REPO_DIRS = [
+    os.path.join(HOME_DIR, name) for name in ("git", "code", "src", "projects", "repos")
+]
+# a git index this big means around 200k tracked files, where scanning for
+# untracked files makes the prompt noticeably slow
+LARGE_GIT_INDEX_BYTES = 20 * 1024 * 1024
+# and this big means even an fsmonitor backed status is too slow for a prompt
+HUGE_GIT_INDEX_BYTES = 100 * 1024 * 1024
+# remote files
+HOMEBREW_INSTALL_URL = (
+    "https://raw.githubusercontent.com/Homebrew/install/HEAD/install.sh"
+)
+UV_INSTALL_URL = "https://astral.sh/uv/install.sh"
+DOCKER_INSTALL_URL = "https://get.docker.com"
+CHROME_DEB_URL = (
+    "https://dl.google.com/linux/direct/google-chrome-stable_current_amd64.deb"
+)
+STEAM_DEB_URL = "https://media.steampowered.com/client/installer/steam.deb"
+SSH_KEY_URL = "https://raw.githubusercontent.com/NathanVaughn/public-keys/main/ssh.pub"
+FONTS_ZIP_URL = (
+    "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/CascadiaCode.zip"
+)
+OMP_INSTALL_URL = "https://ohmyposh.dev/install.sh"
 # colors
 RED = "\033[0;31m"
 LIGHTRED = "\033[1;31m"
@@ -88,13 +170,12 @@ def has_homebrew() -> bool:
     return True if which else os.path.isfile(BREW_PATH)
 
 
-def download_file(url: str) -> str:
+def download_file(url: str, sha256: None | str = None) -> str:
     """
-    Downloads a file and then returns the temp file path.
+    Downloads a file through the download cache and returns its path.
+    The file is kept for later runs, so it must not be modified or removed.
     """
-    print(f"Downloading {url}")
-    file, _ = urllib.request.urlretrieve(url)
-    return file
+    return downloads.fetch(url, sha256=sha256)
 
 
 def sudo(command: list[str]) -> list[str]:
@@ -104,32 +185,255 @@ def sudo(command: list[str]) -> list[str]:
     return ["sudo"] + command
 
 
-def set_git_config_key_value(key: str, value: str) -> None:
+def dpkg_installed() -> dict[str, str]:
     """
-    Sets a git config value globally
+    Returns the version of every installed apt package
     """
-    print(f"Configuring git {key}")
-    run(["git", "config", "--global", key, value])
+    global DPKG_INSTALLED
+
+    with resource("apt"):
+        if DPKG_INSTALLED is None:
+            output = run_output(
+                ["dpkg-query", "-W", "-f", "${Package}\t${Status}\t${Version}\n"]
+            )
+
+            DPKG_INSTALLED = {}
+            for line in output.splitlines():
+                package, status, version = line.split("\t")
+                if status.endswith(" installed"):
+                    DPKG_INSTALLED[package] = version
 
+    return DPKG_INSTALLED
 
-def apt_install_packages(packages: str | list[str]) -> None:
+
+def snap_installed() -> dict[str, str]:
     """
-    Install one or more apt packages
+    Returns the version of every installed snap package
+    """
+    global SNAP_INSTALLED
+
+    with resource("snap"):
+        if SNAP_INSTALLED is None:
+            # first line is a header
+            lines = run_output(["snap", "list"], check=False).splitlines()[1:]
+            SNAP_INSTALLED = {
+                line.split()[0]: line.split()[1] for line in lines if line.strip()
+            }
+
+    return SNAP_INSTALLED
+
+
+def apt_install_packages(
+    packages: str | list[str], defer: bool = False, upgrade: bool = False
+) -> None:
+    """
+    Install one or more apt packages. Deferred packages are only queued, and
+    get installed along with the next packages that are needed right away, or
+    when the queue is flushed at the end of the run. Packages that are
+    already installed are skipped, unless they should be upgraded.
+    """
+    if isinstance(packages, str):
+        packages = [packages]
+
+    with resource("apt"):
+        APT_QUEUE.extend(p for p in packages if p not in APT_QUEUE)
+        if upgrade:
+            APT_UPGRADE.update(packages)
+
+        if not defer:
+            apt_flush()
+
+
+def apt_update() -> None:
+    """
+    Refresh the apt package lists, once per run
     """
     global APT_UPDATED
 
-    if not APT_UPDATED:
-        run(sudo(["apt-get", "update", "-y"]))
-        APT_UPDATED = True
+    with resource("apt"):
+        if not APT_UPDATED:
+            run(sudo(["apt-get", "update", "-y"]))
+            APT_UPDATED = True
 
-    cmd = sudo(["apt-get", "install", "-y"])
 
-    if isinstance(packages, list):
-        cmd += packages
-    else:
-        cmd += [packages]
+def apt_config_path(option: str) -> str:
+    """
+    A file or directory apt is configured to use, such as
+    Dir::State::lists/d
+    """
+    # prints NAME='value'
+    output = run_output(["apt-config", "shell", "NAME", option]).strip()
+    return shlex.split(output.partition("=")[2])[0] if output else ""
 
-    run(cmd)
+
+def apt_print_uris(packages: list[str], everything: bool = False) -> list[dict]:
+    """
+    Ask apt which archives it would download to install packages. With
+    everything, dependencies that are already installed here are included.
+    """
+    cmd = ["apt-get", "install", "--print-uris", "-qq", "-o", "Debug::NoLocking=1"]
+    empty = None
+    if everything:
+        # pretend nothing is installed, and nothing is downloaded already,
+        # since apt leaves out archives that are in its cache
+        empty = tempfile.mkdtemp(prefix="dotfiles-apt-")
+        os.makedirs(os.path.join(empty, "partial"))
+        cmd += [
+            "-o",
+            "Dir::State::status=/dev/null",
+            "-o",
+            f"Dir::Cache::Archives={empty}/",
+            "-o",
+            "Dir::Cache::pkgcache=",
+            "-o",
+            "Dir::Cache::srcpkgcache=",
+        ]
+
+    try:
+        output = run_output(cmd + packages)
+    finally:
+        if empty:
+            shutil.rmtree(empty)
+
+    archives = []
+    for line in output.splitlines():
+        # 'URI' filename size checksum
+        if not line.startswith("'"):
+            continue
+
+        url, filename, size, *checksums = line.split()
+        url = url.strip("'")
+
+        # the strongest hash apt has, such as SHA512:<hex> on Ubuntu
+        algorithm, _, digest = (checksums[0] if checksums else "").partition(":")
+        # MD5Sum is what apt calls md5
+        algorithm = algorithm.lower().removesuffix("sum")
+        if not digest or algorithm not in hashlib.algorithms_available:
+            raise ValueError(f"apt has no usable checksum for {url}")
+
+        archives.append(
+            {
+                "url": url,
+                "filename": filename,
+                "size": int(size),
+                "algorithm": algorithm,
+                "hash": digest,
+                # lets the download cache check the hash itself
+                "sha256": digest if algorithm == "sha256" else None,
+            }
+        )
+
+    return archives
+
+
+def apt_verify_archive(file: str, archive: dict) -> None:
+    """
+    Make sure a downloaded apt archive has the size and hash apt expects.
+    """
+    if os.path.getsize(file) != archive["size"]:
+        raise ValueError(f"{archive['filename']} is not {archive['size']} bytes")
+    if file_hash(file, archive["algorithm"]) != archive["hash"]:
+        raise ValueError(
+            f"{archive['filename']} does not have {archive['algorithm']} hash"
+            f" {archive['hash']}"
+        )
+
+
+def apt_download_archives(packages: list[str]) -> None:
+    """
+    Download the archives apt needs for packages concurrently, spread across
+    the configured mirrors, and put them in apt's cache so it does not have to
+    fetch them one by one itself.
+    """
+    archives = apt_print_uris(packages)
+    if not archives:
+        return
+
+    # try a mirror first, falling back to where apt would download from
+    candidates = []
+    for i, archive in enumerate(archives):
+        urls = [archive["url"]]
+        if APT_MIRRORS and "/pool/" in archive["url"]:
+            mirror = APT_MIRRORS[i % len(APT_MIRRORS)].rstrip("/")
+            urls.insert(0, f"{mirror}/pool/{archive['url'].split('/pool/')[1]}")
+        candidates.append(urls)
+
+    downloads.prefetch([urls[0] for urls in candidates])
+
+    os.makedirs(downloads.CACHE_DIR, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=downloads.CACHE_DIR)
+    try:
+        staged = []
+        for archive, urls in zip(archives, candidates):
+            for url in urls:
+                try:
+                    file = download_file(url, sha256=archive["sha256"])
+                    apt_verify_archive(file, archive)
+                    break
+                except Exception as e:
+                    if url == urls[-1]:
+                        raise
+                    warn(f"Could not download {url} ({e})")
+
+            # name them the way apt expects
+            target = os.path.join(staging, archive["filename"])
+            try:
+                os.link(file, target)
+            except OSError:
+                shutil.copyfile(file, target)
+            staged.append(target)
+
+        run(sudo(["cp"] + staged + ["/var/cache/apt/archives/"]))
+    finally:
+        shutil.rmtree(staging)
+
+
+def apt_flush() -> None:
+    """
+    Install all queued apt packages in a single transaction
+    """
+    with resource("apt"):
+        if not APT_QUEUE:
+            return
+
+        installed = dpkg_installed()
+        packages = [p for p in APT_QUEUE if p in APT_UPGRADE or p not in installed]
+        APT_QUEUE.clear()
+
+        if not packages:
+            return
+
+        cmd = ["apt-get", "install", "-y"]
+        if APT_BUNDLE_DIR:
+            # use the package lists and archives from the bundle only, and the
+            # sources the lists were made from, since apt ignores the lists of
+            # sources it is not configured with
+            sources = os.path.join(APT_BUNDLE_DIR, "sources")
+            cmd += [
+                "--no-download",
+                "-o",
+                f"Dir::State::Lists={os.path.join(APT_BUNDLE_DIR, 'lists')}/",
+                "-o",
+                f"Dir::Cache::Archives={os.path.join(APT_BUNDLE_DIR, 'debs')}/",
+                "-o",
+                f"Dir::Etc::sourcelist={os.path.join(sources, 'sources.list')}",
+                "-o",
+                f"Dir::Etc::sourceparts={os.path.join(sources, 'sources.list.d')}/",
+            ]
+        else:
+            apt_update()
+            if APT_PARALLEL:
+                apt_download_archives(packages)
+
+        run(sudo(cmd + packages))
+        upgraded = [p for p in packages if p in installed]
+        metrics.add(
+            "packages_installed_total", len(packages) - len(upgraded), manager="apt"
+        )
+        metrics.add("packages_upgraded_total", len(upgraded), manager="apt")
+        APT_UPGRADE.difference_update(packages)
+        # exact versions are not needed, only that they are present
+        installed.update({p: "" for p in packages if p not in installed})
 
 
 def bash_run_script_from_url(url: str, args: None | list[str] = None) -> None:
@@ -141,17 +445,14 @@ def bash_run_script_from_url(url: str, args: None | list[str] = None) -> None:
     if args:
         cmd += args
     run(cmd)
-    os.remove(installer)
 
 
 def powershell_run_script_from_url(url: str) -> None:
     """
     Run an powershell script from a URL
     """
-    installer = download_file(url)
     # powershell needs the file to end in .ps1
-    installer_ps1 = f"{installer}.ps1"
-    os.rename(installer, installer_ps1)
+    installer_ps1 = downloads.fetch_copy(url, suffix=".ps1")
 
     pwsh = "powershell"
     if shutil.which("pwsh"):
@@ -161,13 +462,20 @@ def powershell_run_script_from_url(url: str) -> None:
     os.remove(installer_ps1)
 
 
-def install_deb_from_url(url: str) -> None:
+def install_deb_from_url(url: str, package: str) -> None:
     """
-    Install a .deb file from a URL
+    Install a .deb file from a URL, unless the package it contains is
+    already installed.
     """
+    if package in dpkg_installed():
+        print(f"{package} is already installed")
+        return
+
     deb_file = download_file(url)
-    run(sudo(["dpkg", "-i", deb_file]))
-    os.remove(deb_file)
+    with resource("apt"):
+        run(sudo(["dpkg", "-i", deb_file]))
+        dpkg_installed()[package] = ""
+    metrics.add("packages_installed_total", manager="dpkg")
 
 
 def homebrew_install(package: str) -> None:
@@ -195,21 +503,33 @@ def winget_install(package: str) -> None:
 
 def snap_install(package: str, classic: bool = False) -> None:
     """
-    Install a snap package
+    Install a snap package, unless it is already installed
     """
+    if package in snap_installed():
+        print(f"{package} is already installed")
+        return
+
     cmd = sudo(["snap", "install", package])
     if classic:
         cmd += ["--classic"]
-    run(cmd)
+
+    with resource("snap"):
+        run(cmd)
+        snap_installed()[package] = ""
+    metrics.add("packages_installed_total", manager="snap")
 
 
 def get_response(prompt: str) -> bool:
     """
     Prompt user with something and get a boolean response
     """
+    if prompt in ANSWERS:
+        return ANSWERS[prompt]
+
     full_prompt = f"{BOLD}Would you like to {prompt}? {NC}"
     val = input(full_prompt).strip().lower()
-    return val.startswith("y")
+    ANSWERS[prompt] = val.startswith("y")
+    return ANSWERS[prompt]
 
 
 def add_line_to_file(
@@ -217,63 +537,76 @@ def add_line_to_file(
 ) -> None:
     """
     Add a new line to a file. If an existing line is found with the same
-    starting string, it will be replaced.
+    starting word, it will be replaced. To make several changes to the same
+    file, use a LineEditor directly.
     """
-    newline += "\n"
-
-    # make sure parent directory exists
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with LineEditor(filename) as editor:
+        editor.upsert(newline, match_full_line=match_full_line)
 
-    # read file
-    if os.path.isfile(filename):
-        with open(filename, "r") as fp:
-            lines = fp.readlines()
-    else:
-        lines = []
 
-    if match_full_line:
-        # ensure full line is present
-        key = newline
-    else:
-        # ensure something matching the prefix is present
-        key = newline.split(" ", maxsplit=1)[0]
+# decorators
+# =======================================
+def response(prompt: str, followups: None | list[str] = None) -> Callable:
+    """
+    Decorator to require a response to run the function. Follow-up questions
+    the function asks itself are listed so they can be asked while planning.
+    """
 
-    # replace matching line
-    found = False
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs) -> Any:
+            if UNATTENDED:
+                return func(*args, **kwargs)
 
-    for i, line in enumerate(lines):
-        if line.startswith(key):
-            if line == newline:
-                return
+            elif PLANNING:
+                if get_response(prompt):
+                    SELECTED.add(func.__name__)
+                    for followup in followups or []:
+                        get_response(followup)
 
-            lines[i] = newline
-            found = True
-            break
+            elif get_response(prompt):
+                func(*args, **kwargs)
+                return True
 
-    if not found:
-        lines.append(newline)
+        return wrapper
 
-    # write new contents
-    with open(filename, "w") as fp:
-        fp.writelines(lines)
+    return decorator
 
 
-# decorators
-# =======================================
-def response(prompt: str) -> Callable:
+def skip_if_unchanged(
+    sources: Callable[..., list[str]],
+    outputs: Callable[..., list[str]],
+    values: Callable[..., None | list[Any]] = lambda *args, **kwargs: [],
+) -> Callable:
     """
-    Decorator to require a response to run the function
+    Decorator to skip a step when the files it reads, the values it depends on
+    and its own code are the same as when it last ran, and the files it wrote
+    have not been changed since. If values returns None, the step always runs.
     """
 
     def decorator(func: Callable) -> Callable:
+        code = inspect.getsource(func)
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs) -> Any:
-            if UNATTENDED:
+            step_values = values(*args, **kwargs)
+            if step_values is None:
                 return func(*args, **kwargs)
 
-            elif get_response(prompt):
-                func(*args, **kwargs)
-                return True
+            inputs = state.fingerprint(
+                sources(*args, **kwargs), [code, args, kwargs, step_values]
+            )
+            output_files = outputs(*args, **kwargs)
+
+            if state.is_current(
+                func.__name__, inputs, state.fingerprint(output_files, [])
+            ):
+                print(f"Skipping {func.__name__}, nothing has changed")
+                return
+
+            result = func(*args, **kwargs)
+            state.record(func.__name__, inputs, state.fingerprint(output_files, []))
+            return result
 
         return wrapper
 
@@ -311,9 +644,12 @@ def require_linux(func: Callable) -> Callable:
 @require_linux
 @response("use the git-core PPA and update Git")
 def install_util_git_update() -> None:
-    apt_install_packages("software-properties-common")
-    run(sudo(["add-apt-repository", "ppa:git-core/ppa", "-y"]))
-    apt_install_packages("git")
+    # adding the PPA needs the network, and the bundled package lists are
+    # the ones git is installed from anyway
+    if not APT_BUNDLE_DIR:
+        apt_install_packages("software-properties-common")
+        run(sudo(["add-apt-repository", "ppa:git-core/ppa", "-y"]))
+    apt_install_packages("git", defer=True, upgrade=True)
 
 
 # runtimes
@@ -338,9 +674,7 @@ def install_runtime_nodejs() -> None:
 @require_linux
 @response("install Homebrew")
 def install_runtime_homebrew() -> None:
-    bash_run_script_from_url(
-        "https://raw.githubusercontent.com/Homebrew/install/HEAD/install.sh"
-    )
+    bash_run_script_from_url(HOMEBREW_INSTALL_URL)
 
     apt_install_packages("build-essential")
     run([BREW_PATH, "install", "gcc"])
@@ -353,7 +687,7 @@ def install_runtime_uv() -> None:
     elif IS_WINDOWS:
         winget_install("astral-sh.uv")
     elif IS_LINUX:
-        bash_run_script_from_url("https://astral.sh/uv/install.sh")
+        bash_run_script_from_url(UV_INSTALL_URL)
 
 
 # apps
@@ -361,7 +695,7 @@ def install_runtime_uv() -> None:
 @response("install Docker")
 def install_app_docker() -> None:
     if IS_LINUX:
-        bash_run_script_from_url("https://get.docker.com")
+        bash_run_script_from_url(DOCKER_INSTALL_URL)
     elif IS_WINDOWS:
         winget_install("Docker.DockerDesktop")
 
@@ -370,7 +704,8 @@ def install_app_docker() -> None:
 def install_app_chrome() -> None:
     if IS_LINUX:
         install_deb_from_url(
-            "https://dl.google.com/linux/direct/google-chrome-stable_current_amd64.deb"
+            CHROME_DEB_URL,
+            "google-chrome-stable",
         )
     elif IS_WINDOWS:
         winget_install("Google.Chrome")
@@ -380,7 +715,8 @@ def install_app_chrome() -> None:
 def install_app_steam() -> None:
     if IS_LINUX:
         install_deb_from_url(
-            "https://media.steampowered.com/client/installer/steam.deb"
+            STEAM_DEB_URL,
+            "steam-launcher",
         )
     elif IS_WINDOWS:
         winget_install("Valve.Steam")
@@ -406,7 +742,7 @@ def install_app_vscode() -> None:
 @response("install Libreoffice")
 def install_app_libreoffice() -> None:
     if IS_LINUX:
-        apt_install_packages("libreoffice")
+        apt_install_packages("libreoffice", defer=True)
     elif IS_WINDOWS:
         winget_install("TheDocumentFoundation.LibreOffice")
 
@@ -428,22 +764,17 @@ def install_app_discord() -> None:
 @response("install your SSH key")
 def install_ssh_key() -> None:
     authorized_keys = os.path.join(HOME_DIR, ".ssh", "authorized_keys")
-    public_key_file = download_file(
-        "https://raw.githubusercontent.com/NathanVaughn/public-keys/main/ssh.pub"
-    )
-
-    # make sure .ssh dir exists
-    os.makedirs(os.path.dirname(authorized_keys), exist_ok=True)
+    public_key_file = download_file(SSH_KEY_URL)
 
-    # read the public key
+    # read the public keys
     with open(public_key_file, "r") as fp:
-        public_key = fp.read().strip()
+        public_keys = fp.read().strip().splitlines()
 
-    # add the key to the authorized_keys file
-    add_line_to_file(authorized_keys, public_key)
-
-    # delete the temp file
-    os.remove(public_key_file)
+    # add the keys to the authorized_keys file. match the full line, as other
+    # keys of the same type start with the same word
+    with LineEditor(authorized_keys) as editor:
+        for public_key in public_keys:
+            editor.upsert(public_key.strip(), match_full_line=True)
 
     # set permissions
     run(sudo(["chmod", "700", os.path.dirname(authorized_keys)]))
@@ -457,20 +788,16 @@ def install_settings_apt_registry() -> None:
     os.environ["NEXUS_PASSWORD"] = getpass.getpass(
         "Enter your Nexus password: ",
     )
-    run(sudo([sys.executable, os.path.join(LINUX_DIR, "rewrite_apt_sources.py")]))
+    # sudo drops the environment, except what is passed through
+    env = ["NEXUS_USERNAME", "NEXUS_PASSWORD", tracing.TRACE_ENV]
+    script = os.path.join(LINUX_DIR, "rewrite_apt_sources.py")
+    run(sudo([f"--preserve-env={','.join(env)}", sys.executable, script]))
 
 
 @require_linux
 @response("install favorite apt packages")
 def install_settings_favorite_apt_packages() -> None:
-    packages = [
-        "python-is-python3",
-        "bat",
-        "neofetch",
-        "net-tools",
-        "iputils-ping",
-    ]
-    apt_install_packages(packages)
+    apt_install_packages(FAVORITE_APT_PACKAGES, defer=True)
 
 
 @require_windows
@@ -487,36 +814,44 @@ def install_settings_favorite_winget_packages() -> None:
         winget_install(package)
 
 
-@response("change the default Pip registry")
-def install_settings_pip_registry() -> None:
-    src = os.path.join(PKGS_DIR, "pip.ini")
-
+def pip_config_path() -> str:
+    """
+    Where pip reads its user config from
+    """
     if IS_LINUX:
-        target = os.path.join(HOME_DIR, ".config", "pip", "pip.conf")
+        return os.path.join(HOME_DIR, ".config", "pip", "pip.conf")
     elif IS_WINDOWS:
-        target = os.path.join(APPDATA_DIR, "pip", "pip.ini")
+        return os.path.join(APPDATA_DIR, "pip", "pip.ini")
     else:
         raise OSError("Unsupported OS")
 
-    os.makedirs(os.path.dirname(target), exist_ok=True)
-    shutil.copy(src, target)
 
-    print(f"Installed pip config to {target}")
+def posh_themes_dir() -> str:
+    """
+    Where oh-my-posh themes are installed
+    """
+    if IS_WINDOWS:
+        return os.path.join(PROGRAMFILES86_DIR, "oh-my-posh", "themes")
+    elif IS_LINUX:
+        return os.path.join(HOME_DIR, ".poshthemes")
+    else:
+        raise ValueError
+
 
+def pip_entries() -> list[sync.Entry]:
+    return [sync.Entry(os.path.join(PKGS_DIR, "pip.ini"), pip_config_path())]
 
-@response("change the default NPM registry")
-def install_settings_npm_registry() -> None:
-    src = os.path.join(PKGS_DIR, ".npmrc")
-    target = os.path.join(HOME_DIR, ".npmrc")
-    shutil.copy(src, target)
 
-    print(f"Installed npm settings to {target}")
+def npm_entries() -> list[sync.Entry]:
+    return [
+        sync.Entry(os.path.join(PKGS_DIR, ".npmrc"), os.path.join(HOME_DIR, ".npmrc"))
+    ]
 
 
-@require_windows
-@response("install the Windows Terminal settings")
-def install_settings_windows_terminal() -> None:
-    src = os.path.join(WINDOWS_DIR, "wt_settings.json")
+def windows_terminal_entries() -> list[sync.Entry]:
+    if not IS_WINDOWS:
+        return []
+
     target = os.path.join(
         LOCALAPPDATA_DIR,
         "Packages",
@@ -524,38 +859,180 @@ def install_settings_windows_terminal() -> None:
         "LocalState",
         "settings.json",
     )
-    shutil.copy(src, target)
+    return [sync.Entry(os.path.join(WINDOWS_DIR, "wt_settings.json"), target)]
+
+
+def powershell_profile_entries() -> list[sync.Entry]:
+    if not IS_WINDOWS:
+        return []
 
-    print(f"Installed Windows Terminal settings to {target}")
+    name = "Microsoft.PowerShell_profile.ps1"
+    target = os.path.join(DOCUMENTS_DIR, "PowerShell", name)
+    return [sync.Entry(os.path.join(WINDOWS_DIR, name), target)]
+
+
+def bash_profile_entries() -> list[sync.Entry]:
+    if not IS_LINUX:
+        return []
+
+    return [
+        sync.Entry(
+            os.path.join(LINUX_DIR, file), os.path.join(HOME_DIR, file), link=True
+        )
+        for file in sorted(os.listdir(LINUX_DIR))
+        if file.startswith(".")
+    ]
+
+
+def large_git_repos() -> dict[str, int]:
+    """
+    Git repos on this machine that are too big for a full status in the
+    prompt, with the size of their index. Repos given with --large-repo are
+    always included.
+    """
+    repos = {}
+    for path in LARGE_GIT_REPOS:
+        # always treat configured repos as large, even if they are small now
+        index = os.path.join(path, ".git", "index")
+        size = os.path.getsize(index) if os.path.isfile(index) else 0
+        repos[os.path.realpath(path)] = max(size, LARGE_GIT_INDEX_BYTES)
+
+    for directory in GIT_REPO_DIRS:
+        if not os.path.isdir(directory):
+            continue
+
+        for entry in os.scandir(directory):
+            index = os.path.join(entry.path, ".git", "index")
+            if (
+                os.path.isfile(index)
+                and os.path.getsize(index) >= LARGE_GIT_INDEX_BYTES
+            ):
+                repos.setdefault(os.path.realpath(entry.path), os.path.getsize(index))
+
+    return dict(sorted(repos.items()))
+
+
+def oh_my_posh_theme(dry_run: bool = False) -> str:
+    """
+    The theme to install. If there are large git repos on this machine, this
+    is a variant of the theme in this repo with a cheaper git segment for
+    them, so the prompt stays fast no matter the size of the repo. With
+    dry_run, a changed variant is written to a temporary file instead.
+    """
+    src = os.path.join(OMP_DIR, "nathanv-me.omp.json")
+    repos = large_git_repos()
+    if not repos:
+        return src
+
+    with open(src, "r") as fp:
+        theme = json.load(fp)
+
+    for block in theme["blocks"]:
+        for segment in block["segments"]:
+            if segment["type"] != "git":
+                continue
+
+            properties = segment.setdefault("properties", {})
+            # git settings turn on core.fsmonitor, let status use it
+            properties["native_fsmonitor"] = True
+            # scanning the whole tree for untracked files is the slowest part
+            properties["untracked_modes"] = {repo: "no" for repo in repos}
+            properties["ignore_submodules"] = {repo: "all" for repo in repos}
+            # only show the branch in the very largest
+            properties["ignore_status"] = [
+                repo for repo, size in repos.items() if size >= HUGE_GIT_INDEX_BYTES
+            ]
+
+    variant = os.path.join(cache_dir(), "oh-my-posh", "nathanv-me.omp.json")
+    content = json.dumps(theme, indent=4) + "\n"
+
+    # leave the file alone if it is unchanged, so syncing it is a no-op
+    if os.path.isfile(variant):
+        with open(variant, "r") as fp:
+            if fp.read() == content:
+                return variant
+
+    if dry_run:
+        fd, tmp = tempfile.mkstemp(suffix=".omp.json")
+        with os.fdopen(fd, "w") as fp:
+            fp.write(content)
+        atexit.register(os.remove, tmp)
+        return tmp
+
+    print(f"Using a faster git prompt in {', '.join(sorted(repos))}")
+    os.makedirs(os.path.dirname(variant), exist_ok=True)
+    with open(variant, "w") as fp:
+        fp.write(content)
+
+    return variant
+
+
+def oh_my_posh_entries(dry_run: bool = False) -> list[sync.Entry]:
+    target = os.path.join(posh_themes_dir(), "nathanv-me.omp.json")
+    return [sync.Entry(oh_my_posh_theme(dry_run=dry_run), target)]
+
+
+def sync_entries(dry_run: bool = False) -> list[sync.Entry]:
+    """
+    Every file that can be installed from this repo
+    """
+    return (
+        pip_entries()
+        + npm_entries()
+        + windows_terminal_entries()
+        + powershell_profile_entries()
+        + bash_profile_entries()
+        + oh_my_posh_entries(dry_run=dry_run)
+    )
+
+
+@response("change the default Pip registry")
+def install_settings_pip_registry() -> None:
+    if sync.sync(pip_entries()) == 0:
+        print("Pip config is already up to date")
+
+
+@response("change the default NPM registry")
+def install_settings_npm_registry() -> None:
+    if sync.sync(npm_entries()) == 0:
+        print("NPM settings are already up to date")
+
+
+@require_windows
+@response("install the Windows Terminal settings")
+def install_settings_windows_terminal() -> None:
+    if sync.sync(windows_terminal_entries()) == 0:
+        print("Windows Terminal settings are already up to date")
 
 
 @require_windows
 @response("install the Powershell profile")
 def install_settings_powershell_profile() -> None:
-    src = os.path.join(WINDOWS_DIR, "Microsoft.PowerShell_profile.ps1")
-    target = os.path.join(
-        DOCUMENTS_DIR, "PowerShell", "Microsoft.PowerShell_profile.ps1"
-    )
-    shutil.copy(src, target)
-
-    print(f"Installed PowerShell profile to {target}")
+    if sync.sync(powershell_profile_entries()) == 0:
+        print("PowerShell profile is already up to date")
 
 
 @require_linux
 @response("install the Bash profile")
 def install_settings_bash_profile() -> None:
-    for file in os.listdir(LINUX_DIR):
-        if not file.startswith("."):
-            continue
+    if sync.sync(bash_profile_entries()) == 0:
+        print("Bash profile is already up to date")
 
-        src = os.path.join(LINUX_DIR, file)
-        target = os.path.join(HOME_DIR, file)
 
-        if os.path.isfile(target) or os.path.islink(target):
-            os.remove(target)
-
-        print(f"Linking {src} to {target}")
-        os.symlink(src, target)
+@require_linux
+def build_shell_init_cache() -> None:
+    """
+    Start a shell once so the cached output of slow init commands in .bashrc
+    is generated now, instead of when the next terminal is opened
+    """
+    print("Building the shell init cache")
+    # a login shell, so ~/.local/bin is on the PATH
+    subprocess.run(
+        ["bash", "-lic", "true"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
 
 
 @response("install fonts")
@@ -568,16 +1045,12 @@ def install_settings_fonts() -> None:
     else:
         raise OSError("Unsupported OS")
 
-    fonts_zip = download_file(
-        "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/CascadiaCode.zip"
-    )
+    fonts_zip = download_file(FONTS_ZIP_URL)
 
     print(f"Extracting {fonts_zip}")
     with zipfile.ZipFile(fonts_zip, "r") as zip_ref:
         zip_ref.extractall(target)
 
-    os.remove(fonts_zip)
-
     if IS_LINUX:
         apt_install_packages("fontconfig")
         run(sudo(["fc-cache", "-fv"]))
@@ -592,84 +1065,89 @@ def install_settings_oh_my_posh(install_bin: bool) -> None:
         if install_bin:
             winget_install("JanDeDobbeleer.OhMyPosh")
 
-        posh_themes = os.path.join(PROGRAMFILES86_DIR, "oh-my-posh", "themes")
-
     elif IS_LINUX:
         if install_bin:
             apt_install_packages("unzip")
             os.makedirs(os.path.join(HOME_DIR, ".local", "bin"), exist_ok=True)
-            bash_run_script_from_url(
-                "https://ohmyposh.dev/install.sh", args=["-d", "~/.local/bin/"]
-            )
-
-        posh_themes = os.path.join(HOME_DIR, ".poshthemes")
-    else:
-        raise ValueError
-
-    os.makedirs(posh_themes, exist_ok=True)
-    shutil.copy(os.path.join(OMP_DIR, "nathanv-me.omp.json"), posh_themes)
-
-
-@response("install Git settings")
+            bash_run_script_from_url(OMP_INSTALL_URL, args=["-d", "~/.local/bin/"])
+
+    sync.sync(oh_my_posh_entries())
+
+
+@response(
+    "install Git settings",
+    followups=[
+        "set the Git email to your personal address",
+        "configure Git to use your GPG key",
+    ],
+)
+@skip_if_unchanged(
+    sources=lambda: [],
+    outputs=lambda: [GITCONFIG, GPG_AGENT_CONF],
+    values=lambda: [
+        get_response("set the Git email to your personal address"),
+        get_response("configure Git to use your GPG key"),
+        shutil.which("git"),
+        shutil.which("gpg"),
+    ],
+)
 def install_settings_git_config() -> None:
     email = get_response("set the Git email to your personal address")
     gpg = get_response("configure Git to use your GPG key")
 
-    set_git_config_key_value("user.name", "Nathan Vaughn")
-
-    set_git_config_key_value("color.status.added", "green bold")
-    set_git_config_key_value("color.status.changed", "red bold strike")
-    set_git_config_key_value("color.status.untracked", "cyan")
-    set_git_config_key_value("color.status.branch", "yellow black bold ul")
-
-    set_git_config_key_value("init.defaultBranch", "main")
-    set_git_config_key_value("help.autoCorrect", "prompt")
-    set_git_config_key_value("core.fsmonitor", "true")
-    set_git_config_key_value("credential.helper", "store")
+    values = {
+        "user.name": "Nathan Vaughn",
+        "color.status.added": "green bold",
+        "color.status.changed": "red bold strike",
+        "color.status.untracked": "cyan",
+        "color.status.branch": "yellow black bold ul",
+        "init.defaultBranch": "main",
+        "help.autoCorrect": "prompt",
+        "core.fsmonitor": "true",
+        "credential.helper": "store",
+    }
 
     if email:
-        set_git_config_key_value("user.email", "nath@nvaughn.email")
+        values["user.email"] = "nath@nvaughn.email"
 
     if gpg:
-        gpg_config = os.path.join(HOME_DIR, ".gnupg", "gpg-agent.conf")
-
-        set_git_config_key_value(
-            "user.signingkey", "958AB43C3CBC4E7EBBC1979769893C308784B59B"
-        )
-        set_git_config_key_value("commit.gpgsign", "true")
+        values["user.signingkey"] = "958AB43C3CBC4E7EBBC1979769893C308784B59B"
+        values["commit.gpgsign"] = "true"
 
         if IS_WINDOWS:
-            set_git_config_key_value(
-                "gpg.program", "C:\\Program Files\\Git\\usr\\bin\\gpg.exe"
-            )
-
+            values["gpg.program"] = "C:\\Program Files\\Git\\usr\\bin\\gpg.exe"
         elif IS_WSL:
             apt_install_packages(["gpg", "gnupg2", "socat"])
-
-            set_git_config_key_value(
-                "gpg.program", "/mnt/c/Program Files/Git/usr/bin/gpg.exe"
-            )
-            add_line_to_file(
-                gpg_config,
-                "pinentry-program /mnt/c/Program Files/Git/usr/bin/pinentry.exe",
-            )
-
-            run(["gpg-connect-agent", "reloadagent", "/bye"])
-
+            values["gpg.program"] = "/mnt/c/Program Files/Git/usr/bin/gpg.exe"
         elif IS_LINUX:
             apt_install_packages(["gpg", "gnupg2"])
+            values["gpg.program"] = which("gpg")
+
+    changed = gitconfig.set_values(GITCONFIG, values)
+    for key in changed:
+        print(f"Configured git {key}")
+    if not changed:
+        print("Git is already configured")
 
-            set_git_config_key_value("gpg.program", which("gpg"))
+    if gpg:
+        with LineEditor(GPG_AGENT_CONF) as editor:
+            if IS_WSL:
+                editor.upsert(
+                    "pinentry-program /mnt/c/Program Files/Git/usr/bin/pinentry.exe"
+                )
+
+            # increase timeout
+            editor.upsert("default-cache-ttl 86400")
+            editor.upsert("max-cache-ttl 86400")
 
-        # increase timeout
-        add_line_to_file(gpg_config, "default-cache-ttl 86400")
-        add_line_to_file(gpg_config, "max-cache-ttl 86400")
+        if IS_WSL:
+            run(["gpg-connect-agent", "reloadagent", "/bye"])
 
 
 @require_linux
 @response("install Gnome-tweaks")
 def install_settings_gnome_tweaks() -> None:
-    apt_install_packages(["gnome-tweaks", "gnome-browser-connector"])
+    apt_install_packages(["gnome-tweaks", "gnome-browser-connector"], defer=True)
     info("Remember to open https://extensions.gnome.org/ afterwards")
 
 
@@ -701,7 +1179,166 @@ def install_chrome_manifest_v2() -> None:
             json.dump({"ExtensionManifestV2Availability": 2}, fp)
 
 
-def main(devcontainer: bool = False) -> None:
+def linux_urls(url: str, package: None | str = None) -> Callable[[], list[str]]:
+    """
+    URLs a step needs only on Linux, and only if the package they install
+    is missing. Checked once the step is chosen, so nothing is looked up for
+    steps that do not run.
+    """
+
+    def urls() -> list[str]:
+        if not IS_LINUX or (package and not EXPORTING and package in dpkg_installed()):
+            return []
+        return [url]
+
+    return urls
+
+
+def selected_urls(steps: list[Step]) -> list[str]:
+    """
+    Every URL the chosen steps need.
+    """
+    urls = []
+    for step in steps:
+        if step.name in SELECTED:
+            urls += step.urls() if callable(step.urls) else step.urls
+    return urls
+
+
+def plan(steps: list[Step]) -> None:
+    """
+    Ask every question up front, so the selected steps can then run
+    unattended and in parallel.
+    """
+    global PLANNING
+
+    PLANNING = True
+    try:
+        for step in steps:
+            step.func(*step.args, **step.kwargs)
+    finally:
+        PLANNING = False
+
+
+def export_bundle(steps: list[Step], path: str) -> None:
+    """
+    Download everything the chosen steps need into one compressed bundle,
+    so they can be installed on machines without network access.
+    """
+    chosen = [step for step in steps if step.name in SELECTED]
+    urls = sorted(set(selected_urls(steps)))
+    packages = sorted({package for step in chosen for package in step.packages})
+
+    archives = []
+    if IS_LINUX and packages:
+        apt_update()
+        archives = apt_print_uris(packages, everything=True)
+
+    downloads.prefetch(urls + [archive["url"] for archive in archives])
+
+    # cached files are named by their hash, the rest are hashed here
+    index: dict[str, dict[str, str]] = {
+        "files": {},
+        "debs": {},
+        "lists": {},
+        "sources": {},
+    }
+
+    with tarfile.open(path, "w:gz") as tar:
+        for url in urls:
+            file = download_file(url)
+            index["files"][url] = os.path.basename(file)
+            tar.add(file, arcname=f"files/{os.path.basename(file)}")
+
+        for archive in archives:
+            file = download_file(archive["url"], sha256=archive["sha256"])
+            apt_verify_archive(file, archive)
+            index["debs"][archive["filename"]] = os.path.basename(file)
+            tar.add(file, arcname=f"debs/{archive['filename']}")
+
+        if archives:
+            # the package lists the archives were resolved against
+            extra = {}
+            for entry in os.scandir(apt_config_path("Dir::State::lists/d")):
+                if entry.is_file() and entry.name != "lock":
+                    extra[f"lists/{entry.name}"] = entry.path
+
+            # and the sources they came from, since apt only reads the lists
+            # of sources it is configured with
+            sourcelist = apt_config_path("Dir::Etc::sourcelist/f")
+            if os.path.isfile(sourcelist):
+                extra["sources/sources.list"] = sourcelist
+            sourceparts = apt_config_path("Dir::Etc::sourceparts/d")
+            if os.path.isdir(sourceparts):
+                for entry in os.scandir(sourceparts):
+                    if entry.is_file():
+                        extra[f"sources/sources.list.d/{entry.name}"] = entry.path
+
+            for arcname, file in extra.items():
+                kind, name = arcname.split("/", maxsplit=1)
+                index[kind][name] = file_sha256(file)
+                tar.add(file, arcname=arcname)
+
+        data = json.dumps(index, indent=2).encode("utf-8")
+        info = tarfile.TarInfo("index.json")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+    print(f"Wrote {len(urls)} files and {len(archives)} apt archives to {path}")
+
+
+def load_bundle(path: str) -> None:
+    """
+    Unpack a bundle made with --export-bundle, and install from it instead of
+    the network.
+    """
+    global APT_BUNDLE_DIR, APT_UPDATED
+
+    target = tempfile.mkdtemp(prefix="dotfiles-bundle-")
+    atexit.register(shutil.rmtree, target, ignore_errors=True)
+    print(f"Unpacking {path} to {target}")
+
+    with tarfile.open(path, "r:gz") as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(target, filter="data")
+        else:
+            tar.extractall(target)
+
+    with open(os.path.join(target, "index.json"), "r") as fp:
+        index = json.load(fp)
+
+    for kind, entries in index.items():
+        for name, sha256 in entries.items():
+            file = os.path.join(target, kind, sha256 if kind == "files" else name)
+            if file_sha256(file) != sha256:
+                raise ValueError(f"{name} in {path} is corrupt")
+
+    downloads.OFFLINE = {
+        url: os.path.join(target, "files", sha256)
+        for url, sha256 in index["files"].items()
+    }
+
+    if index["debs"]:
+        # apt wants these to exist, even though nothing is downloaded
+        os.makedirs(os.path.join(target, "lists", "partial"), exist_ok=True)
+        os.makedirs(os.path.join(target, "debs", "partial"), exist_ok=True)
+        os.makedirs(os.path.join(target, "sources", "sources.list.d"), exist_ok=True)
+        APT_BUNDLE_DIR = target
+        APT_UPDATED = True
+
+
+def main(
+    devcontainer: bool = False,
+    jobs: int = 1,
+    bundle: None | str = None,
+    from_bundle: None | str = None,
+    diff: bool = False,
+) -> None:
+    if diff:
+        if sync.sync(sync_entries(dry_run=True), dry_run=True) == 0:
+            print("Everything is up to date")
+        return
+
     if devcontainer:
         print("Running in devcontainer mode")
         global UNATTENDED
@@ -709,43 +1346,108 @@ def main(devcontainer: bool = False) -> None:
 
         install_settings_bash_profile()
         install_settings_oh_my_posh(install_bin=False)
+        shell_init.build_lazy_init()
+        build_shell_init_cache()
         # git settings are already copied in
         return
 
-    # utils
-    install_util_git_update()
-
-    # runtimes
-    install_runtime_uv()
-
-    # apps
-    install_app_docker()
-    install_app_chrome()
-    install_app_steam()
-    install_app_spotify()
-    install_app_vscode()
-    install_app_libreoffice()
-    install_app_discord()
-
-    # settings
-    install_ssh_key()
-    # install_settings_apt_registry()
-    install_settings_favorite_apt_packages()
-    install_settings_favorite_winget_packages()
-    # install_settings_pip_registry()
-    # install_settings_npm_registry()
-    powershell_profile_installed = install_settings_powershell_profile()
-    install_settings_windows_terminal()
-    bash_profile_installed = install_settings_bash_profile()
-    install_settings_fonts()
-    install_settings_oh_my_posh(install_bin=True)
-    install_settings_git_config()
-    install_settings_gnome_tweaks()
-    install_settings_bing_wallpaper()
-
-    if powershell_profile_installed:
+    if bundle:
+        global EXPORTING
+        EXPORTING = True
+    if from_bundle:
+        load_bundle(from_bundle)
+
+    steps = [
+        # utils
+        Step(
+            install_util_git_update,
+            locks=["apt"],
+            packages=["software-properties-common", "git"],
+        ),
+        # runtimes
+        Step(install_runtime_uv, urls=linux_urls(UV_INSTALL_URL)),
+        # apps
+        # the Docker install script drives apt itself
+        Step(install_app_docker, locks=["apt"], urls=linux_urls(DOCKER_INSTALL_URL)),
+        Step(
+            install_app_chrome,
+            urls=linux_urls(CHROME_DEB_URL, package="google-chrome-stable"),
+        ),
+        Step(
+            install_app_steam, urls=linux_urls(STEAM_DEB_URL, package="steam-launcher")
+        ),
+        Step(install_app_spotify),
+        Step(install_app_vscode),
+        Step(install_app_libreoffice, packages=["libreoffice"]),
+        Step(install_app_discord),
+        # settings
+        Step(install_ssh_key, urls=[SSH_KEY_URL]),
+        # Step(install_settings_apt_registry, locks=["apt"]),
+        Step(install_settings_favorite_apt_packages, packages=FAVORITE_APT_PACKAGES),
+        Step(install_settings_favorite_winget_packages),
+        # Step(install_settings_pip_registry),
+        # Step(install_settings_npm_registry),
+        Step(install_settings_powershell_profile),
+        Step(install_settings_windows_terminal),
+        Step(install_settings_bash_profile),
+        Step(install_settings_fonts, urls=[FONTS_ZIP_URL], packages=["fontconfig"]),
+        Step(
+            install_settings_oh_my_posh,
+            kwargs={"install_bin": True},
+            urls=linux_urls(OMP_INSTALL_URL),
+            packages=["unzip"],
+        ),
+        Step(
+            install_settings_git_config,
+            after=[install_util_git_update],
+            packages=["gpg", "gnupg2", "socat"] if IS_WSL else ["gpg", "gnupg2"],
+        ),
+        Step(
+            install_settings_gnome_tweaks,
+            packages=["gnome-tweaks", "gnome-browser-connector"],
+        ),
+        Step(install_settings_bing_wallpaper),
+    ]
+
+    plan(steps)
+
+    if IS_LINUX and SELECTED:
+        # ask for the password once, before steps running in parallel all
+        # ask for it at the same time
+        subprocess.run(["sudo", "-v"])
+
+    if bundle:
+        export_bundle(steps, bundle)
+        return
+
+    # start downloading everything the chosen steps need
+    downloads.prefetch(selected_urls(steps))
+
+    failed = True
+    try:
+        results = run_steps(steps, jobs=jobs)
+        failed = False
+    finally:
+        downloads.cancel_prefetch()
+        try:
+            # install everything that was deferred in one go
+            apt_flush()
+        except Exception:
+            failed = True
+            raise
+        finally:
+            metrics.write("install", failed)
+
+    if (
+        results["install_settings_bash_profile"]
+        or results["install_settings_oh_my_posh"]
+    ):
+        shell_init.build_lazy_init()
+        build_shell_init_cache()
+
+    if results["install_settings_powershell_profile"]:
         print(f"Run {BOLD}. $PROFILE{NC} to refresh your PowerShell profile.")
-    if bash_profile_installed:
+    if results["install_settings_bash_profile"]:
         print(
             f"Run {BOLD}source {HOME_DIR}/.bash_profile{NC} to refresh your Bash profile."
         )
@@ -758,6 +1460,75 @@ if __name__ == "__main__":
         action="store_true",
         help="Install dotfiles unattended in a devcontainer",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="Number of steps to run at the same time",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=downloads.CACHE_DIR,
+        help="Directory to cache downloads in, which can be shared between machines",
+    )
+    parser.add_argument(
+        "--export-bundle",
+        metavar="PATH",
+        help="Instead of installing, save everything the chosen steps need to a bundle",
+    )
+    parser.add_argument(
+        "--from-bundle",
+        metavar="PATH",
+        help="Install from a bundle instead of the network",
+    )
+    parser.add_argument(
+        "--parallel-apt",
+        action="store_true",
+        help="Download apt archives in parallel before installing them",
+    )
+    parser.add_argument(
+        "--apt-mirror",
+        action="append",
+        default=[],
+        metavar="URL",
+        help="Mirror to spread parallel apt downloads over, can be repeated",
+    )
+    parser.add_argument(
+        "--large-repo",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="Git repo to use a faster prompt in, can be repeated",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="Write a trace of this run here, to open in chrome://tracing or Perfetto",
+    )
+    parser.add_argument(
+        "--metrics-dir",
+        metavar="PATH",
+        help="Write metrics about this run here, as a Prometheus textfile and JSON",
+    )
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        help="Show how installed files differ from this repo, without changing them",
+    )
     args = parser.parse_args()
 
-    main(devcontainer=args.devcontainer)
+    downloads.CACHE_DIR = args.cache_dir
+    APT_PARALLEL = args.parallel_apt
+    APT_MIRRORS = args.apt_mirror
+    LARGE_GIT_REPOS = args.large_repo
+    metrics.METRICS_DIR = args.metrics_dir
+    if args.trace:
+        tracing.start(args.trace)
+    main(
+        devcontainer=args.devcontainer,
+        jobs=args.jobs,
+        bundle=args.export_bundle,
+        from_bundle=args.from_bundle,
+        diff=args.diff,
+    )
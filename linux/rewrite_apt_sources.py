@@ -9,6 +9,11 @@ import urllib.error
 import urllib.request
 from typing import List, Optional
 
+# for the shared modules in the root of the repo
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import tracing  # noqa: E402
+
 NEXUS_URL = "https://pkgs.nathanv.app"
 NEXUS_USERNAME = os.environ["NEXUS_USERNAME"]
 NEXUS_PASSWORD = os.environ["NEXUS_PASSWORD"]
@@ -64,7 +69,8 @@ def get_or_create_repo_name(upstream_url: str, distribution: str) -> str:
     )
 
     try:
-        get_response = urllib.request.urlopen(get_request)
+        with tracing.span(f"GET {repo_name}", "nexus", url=get_request.full_url):
+            get_response = urllib.request.urlopen(get_request)
         if get_response.getcode() == 200:
             return repo_name
     except urllib.error.HTTPError as e:
@@ -100,7 +106,8 @@ def get_or_create_repo_name(upstream_url: str, distribution: str) -> str:
         },
         method="POST",
     )
-    urllib.request.urlopen(post_request)
+    with tracing.span(f"POST {repo_name}", "nexus", url=post_request.full_url):
+        urllib.request.urlopen(post_request)
 
     return repo_name
 
@@ -201,7 +208,8 @@ def main() -> bool:
             continue
 
         # if a change was made, set that
-        result = process_file(source_list)
+        with tracing.span(source_list.name, "apt sources"):
+            result = process_file(source_list)
         if result:
             changes_made = True
 
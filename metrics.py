@@ -0,0 +1,112 @@
+import os
+import socket
+import threading
+import time
+
+from utils import atomic_write, write_json
+
+# when set, metrics are written here at the end of a run, such as the
+# directory of node_exporter's textfile collector
+METRICS_DIR: None | str = None
+
+# type and help text of every metric
+METRICS = {
+    "run_duration_seconds": ("gauge", "How long the whole run took"),
+    "run_timestamp_seconds": ("gauge", "When the run finished"),
+    "run_failed": ("gauge", "Whether anything in the run failed"),
+    "step_duration_seconds": ("gauge", "How long each step took"),
+    "step_failed": ("gauge", "Whether each step failed"),
+    "download_bytes_total": ("counter", "Bytes downloaded"),
+    "download_cache_hits_total": ("counter", "Downloads served from the cache"),
+    "download_cache_misses_total": ("counter", "Downloads fetched from the network"),
+    "packages_installed_total": ("counter", "Packages installed"),
+    "packages_upgraded_total": ("counter", "Packages upgraded"),
+    "failures_total": ("counter", "Commands that failed"),
+}
+
+_LOCK = threading.Lock()
+_VALUES: dict[tuple, float] = {}
+_START = time.time()
+
+
+def _key(name: str, labels: dict[str, str]) -> tuple:
+    if name not in METRICS:
+        raise KeyError(f"Unknown metric {name}")
+    return (name, *sorted(labels.items()))
+
+
+def add(name: str, value: float = 1, **labels: str) -> None:
+    """
+    Add to a metric.
+    """
+    key = _key(name, labels)
+    with _LOCK:
+        _VALUES[key] = _VALUES.get(key, 0) + value
+
+
+def set_value(name: str, value: float, **labels: str) -> None:
+    """
+    Set a metric to a value.
+    """
+    with _LOCK:
+        _VALUES[_key(name, labels)] = value
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(script: str, values: dict[tuple, float]) -> str:
+    """
+    Format metrics in the Prometheus text format.
+    """
+    lines = []
+    for name, (type_, help_) in METRICS.items():
+        samples = sorted(key for key in values if key[0] == name)
+        if not samples:
+            continue
+
+        lines.append(f"# HELP dotfiles_{name} {help_}")
+        lines.append(f"# TYPE dotfiles_{name} {type_}")
+        for key in samples:
+            labels = ",".join(
+                f'{label}="{_escape(value)}"'
+                for label, value in [("script", script), *key[1:]]
+            )
+            lines.append(f"dotfiles_{name}{{{labels}}} {values[key]:.15g}")
+
+    return "\n".join(lines) + "\n"
+
+
+def write(script: str, failed: bool) -> None:
+    """
+    Write the metrics of this run for a script, if a metrics directory was
+    given. Both a Prometheus textfile and JSON are written, each atomically
+    so a collector never reads half of one.
+    """
+    if not METRICS_DIR:
+        return
+
+    set_value("run_duration_seconds", time.time() - _START)
+    set_value("run_timestamp_seconds", time.time())
+    set_value("run_failed", int(failed))
+
+    with _LOCK:
+        values = dict(_VALUES)
+
+    path = os.path.join(METRICS_DIR, f"dotfiles_{script}")
+
+    # the textfile collector only reads .prom files
+    atomic_write(f"{path}.prom", _format(script, values), mode=0o644)
+
+    write_json(
+        f"{path}.json",
+        {
+            "script": script,
+            "host": socket.gethostname(),
+            "metrics": [
+                {"name": key[0], "labels": dict(key[1:]), "value": value}
+                for key, value in sorted(values.items())
+            ],
+        },
+    )
@@ -0,0 +1,132 @@
+import threading
+import time
+import traceback
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Iterator
+
+import metrics
+import tracing
+
+# shared resources that steps must not use concurrently
+LOCKS: dict[str, Any] = {
+    # dpkg/apt frontend lock
+    "apt": threading.RLock(),
+    # snapd only processes one change at a time
+    "snap": threading.RLock(),
+    # cap the number of concurrent downloads
+    "network": threading.BoundedSemaphore(4),
+}
+
+
+@contextmanager
+def resource(*names: str) -> Iterator[None]:
+    """
+    Hold one or more shared resource locks. Locks are always acquired in
+    sorted order so that two holders can never deadlock each other.
+    """
+    with ExitStack() as stack:
+        for name in sorted(set(names)):
+            lock = LOCKS[name]
+            if not lock.acquire(blocking=False):
+                # only trace the time spent waiting for a lock someone holds
+                with tracing.span(f"lock {name}", "lock"):
+                    lock.acquire()
+            stack.callback(lock.release)
+        yield
+
+
+@dataclass
+class Step:
+    """
+    A function to run, the steps it must wait for, the shared resources
+    it holds for its whole duration, and the remote files and apt packages
+    it will need. The remote files can also be a function that finds them,
+    for when that is only worth doing if the step runs.
+    """
+
+    func: Callable
+    args: tuple = ()
+    kwargs: dict = field(default_factory=dict)
+    after: list[Callable] = field(default_factory=list)
+    locks: list[str] = field(default_factory=list)
+    urls: list[str] | Callable[[], list[str]] = field(default_factory=list)
+    packages: list[str] = field(default_factory=list)
+
+    @property
+    def name(self) -> str:
+        return self.func.__name__
+
+    def __call__(self) -> Any:
+        with resource(*self.locks):
+            # not counting the time spent waiting for locks
+            start = time.monotonic()
+            try:
+                with tracing.span(self.name, "step"):
+                    return self.func(*self.args, **self.kwargs)
+            finally:
+                metrics.set_value(
+                    "step_duration_seconds", time.monotonic() - start, step=self.name
+                )
+
+
+def run_steps(steps: list[Step], jobs: int = 1) -> dict[str, Any]:
+    """
+    Run steps on a pool of workers as soon as everything they depend on has
+    finished. Dependencies on functions that are not in the list are treated
+    as already satisfied. Steps are started in the order given, so with a
+    single worker this behaves exactly like calling them one after another.
+    Returns the result of each step by name, and raises if any step failed.
+    """
+    by_func = {step.func: step for step in steps}
+    waiting = list(steps)
+    results: dict[str, Any] = {}
+    failed: set[str] = set()
+    running: dict[Future, Step] = {}
+
+    def ready(step: Step) -> bool:
+        return all(
+            dep not in by_func or by_func[dep].name in results for dep in step.after
+        )
+
+    def blocked(step: Step) -> bool:
+        return any(dep in by_func and by_func[dep].name in failed for dep in step.after)
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        while waiting or running:
+            for step in list(waiting):
+                if blocked(step):
+                    print(f"Skipping {step.name}, a step it depends on failed")
+                    waiting.remove(step)
+                    failed.add(step.name)
+                elif ready(step):
+                    waiting.remove(step)
+                    running[pool.submit(step)] = step
+
+            if not running:
+                if not waiting:
+                    # the last steps were skipped because of a failure
+                    break
+                # everything left depends on something that can never finish
+                raise RuntimeError(
+                    f"Unsatisfiable steps: {', '.join(s.name for s in waiting)}"
+                )
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                try:
+                    results[step.name] = future.result()
+                    metrics.set_value("step_failed", 0, step=step.name)
+                except Exception:
+                    traceback.print_exc()
+                    print(f"Step {step.name} failed")
+                    failed.add(step.name)
+                    metrics.set_value("step_failed", 1, step=step.name)
+
+    if failed:
+        raise RuntimeError(f"Failed steps: {', '.join(sorted(failed))}")
+
+    return results
@@ -0,0 +1,88 @@
+import os
+import re
+import shutil
+
+from utils import IS_LINUX, atomic_write, cache_dir
+
+HOME_DIR = os.path.expanduser("~")
+# generated files sourced by .bashrc
+SHELL_INIT_DIR = os.path.join(cache_dir(), "shell-init")
+FNM_DIR = os.environ.get("FNM_DIR") or os.path.join(
+    os.environ.get("XDG_DATA_HOME") or os.path.join(HOME_DIR, ".local", "share"),
+    "fnm",
+)
+BASH_COMPLETION_SCRIPTS = [
+    "/usr/share/bash-completion/bash_completion",
+    "/etc/bash_completion",
+]
+
+
+def lazy_fnm_commands() -> list[str]:
+    """
+    Commands that need the fnm environment: node and the tools that come
+    with it, plus any global packages installed in the default version
+    """
+    commands = {"fnm", "node", "npm", "npx", "corepack"}
+
+    bin_dir = os.path.join(FNM_DIR, "aliases", "default", "bin")
+    if os.path.isdir(bin_dir):
+        commands.update(
+            file
+            for file in os.listdir(bin_dir)
+            if re.fullmatch(r"[\w.+-]+", file)
+            and os.access(os.path.join(bin_dir, file), os.X_OK)
+        )
+
+    return sorted(commands)
+
+
+def build_lazy_init() -> None:
+    """
+    Generate the stubs .bashrc uses to set up tools and completions the first
+    time they are needed, for whichever of them are on this machine
+    """
+    if not IS_LINUX:
+        return
+
+    lines = ["# generated by install.py, do not edit"]
+
+    # look where the bash profile adds to the PATH, too
+    path = os.pathsep.join(
+        [os.environ.get("PATH", ""), os.path.join(HOME_DIR, ".local", "bin"), FNM_DIR]
+    )
+    fnm = shutil.which("fnm", path=path)
+    if fnm:
+        commands = lazy_fnm_commands()
+        lines += [
+            "",
+            "# set up the fnm environment the first time node is used",
+            "_lazy_fnm() {",
+            f"    unset -f _lazy_fnm {' '.join(commands)}",
+            f"    [[ :$PATH: == *:{os.path.dirname(fnm)}:* ]] || "
+            f"export PATH={os.path.dirname(fnm)}:$PATH",
+            '    eval "$(fnm env --use-on-cd --shell bash)"',
+            "}",
+        ]
+        lines += [
+            f'{command}() {{ _lazy_fnm && {command} "$@"; }}' for command in commands
+        ]
+
+    completion = next(
+        (script for script in BASH_COMPLETION_SCRIPTS if os.path.isfile(script)), None
+    )
+    if completion:
+        lines += [
+            "",
+            "# load bash-completion on the first TAB, then retry the completion",
+            "_lazy_completion() {",
+            "    complete -r -D",
+            f"    . {completion}",
+            "    return 124",
+            "}",
+            "shopt -oq posix || complete -D -F _lazy_completion",
+        ]
+
+    target = os.path.join(SHELL_INIT_DIR, "lazy.sh")
+    atomic_write(target, "\n".join(lines) + "\n", mode=0o644)
+
+    print(f"Generated {target}")
@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Any
+
+from utils import file_sha256, state_dir, write_json
+
+STATE_FILE = os.path.join(state_dir(), "steps.json")
+
+_LOCK = threading.Lock()
+
+
+def fingerprint(files: list[str], values: list[Any]) -> str:
+    """
+    Hash the contents of some files along with some values.
+    """
+    digest = hashlib.sha256()
+
+    for file in files:
+        digest.update(file.encode("utf-8"))
+        if os.path.isfile(file):
+            digest.update(file_sha256(file).encode("utf-8"))
+        else:
+            digest.update(b"missing")
+
+    digest.update(json.dumps(values, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _load() -> dict[str, dict[str, str]]:
+    """
+    Load the recorded fingerprints of every step.
+    """
+    try:
+        with open(STATE_FILE, "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def is_current(name: str, inputs: str, outputs: str) -> bool:
+    """
+    Check if a step last ran with the same inputs, and its outputs have not
+    been changed since.
+    """
+    with _LOCK:
+        recorded = _load().get(name)
+
+    return recorded == {"inputs": inputs, "outputs": outputs}
+
+
+def record(name: str, inputs: str, outputs: str) -> None:
+    """
+    Record the fingerprints of a step that just ran.
+    """
+    with _LOCK:
+        state = _load()
+        state[name] = {"inputs": inputs, "outputs": outputs}
+        write_json(STATE_FILE, state)
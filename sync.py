@@ -0,0 +1,160 @@
+import difflib
+import json
+import os
+import shutil
+import stat
+import threading
+from dataclasses import dataclass
+
+from utils import atomic_write, file_sha256, state_dir, write_json
+
+# what each target looked like the last time it was synced
+MANIFEST_FILE = os.path.join(state_dir(), "sync.json")
+
+_LOCK = threading.Lock()
+
+
+@dataclass
+class Entry:
+    """
+    A file in this repo and where it should be installed, either as a symlink
+    or as a copy.
+    """
+
+    source: str
+    target: str
+    link: bool = False
+
+
+def _load() -> dict[str, dict]:
+    """
+    Load the manifest of synced targets.
+    """
+    try:
+        with open(MANIFEST_FILE, "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def _stat(path: str) -> list[int]:
+    """
+    Size and modification time of a file, to notice changes without hashing.
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _record(entry: Entry) -> dict:
+    """
+    Manifest record of a copied target.
+    """
+    return {
+        "source": _stat(entry.source),
+        "target": _stat(entry.target),
+        "sha256": file_sha256(entry.target),
+    }
+
+
+def _action(entry: Entry, manifest: dict[str, dict]) -> None | str:
+    """
+    What needs to be done to a target, if anything.
+    """
+    exists = os.path.lexists(entry.target)
+
+    if entry.link:
+        if os.path.islink(entry.target):
+            if os.readlink(entry.target) == entry.source:
+                return None
+        return "relink" if exists else "link"
+
+    if not exists:
+        return "copy"
+    if os.path.islink(entry.target) or not os.path.isfile(entry.target):
+        return "replace"
+
+    record = manifest.get(entry.target)
+    source_unchanged = record and record["source"] == _stat(entry.source)
+    if source_unchanged and record["target"] == _stat(entry.target):
+        return None
+
+    # only the timestamps may have changed, so compare the contents
+    source_sha256 = record["sha256"] if source_unchanged else file_sha256(entry.source)
+    if source_sha256 == file_sha256(entry.target):
+        # same contents, only remember the new timestamps
+        manifest[entry.target] = _record(entry)
+        return None
+
+    return "update"
+
+
+def _diff(entry: Entry) -> None:
+    """
+    Print how a copied target would change.
+    """
+    try:
+        with open(entry.target, "r") as fp:
+            old = fp.readlines()
+        with open(entry.source, "r") as fp:
+            new = fp.readlines()
+    except UnicodeDecodeError:
+        print(f"Binary files {entry.target} and {entry.source} differ")
+        return
+
+    print("".join(difflib.unified_diff(old, new, entry.target, entry.source)), end="")
+
+
+def _apply(entry: Entry) -> None:
+    """
+    Make a target match its source.
+    """
+    directory = os.path.dirname(entry.target)
+    os.makedirs(directory, exist_ok=True)
+
+    if entry.link:
+        print(f"Linking {entry.source} to {entry.target}")
+        # create the new link next to the old one, then swap them
+        tmp = f"{entry.target}.{os.getpid()}.tmp"
+        os.symlink(entry.source, tmp)
+        os.replace(tmp, entry.target)
+        return
+
+    print(f"Copying {entry.source} to {entry.target}")
+    with open(entry.source, "rb") as fp:
+        data = fp.read()
+    if os.path.isdir(entry.target) and not os.path.islink(entry.target):
+        shutil.rmtree(entry.target)
+    atomic_write(entry.target, data, mode=stat.S_IMODE(os.stat(entry.source).st_mode))
+
+
+def sync(entries: list[Entry], dry_run: bool = False) -> int:
+    """
+    Make every target match its source, only touching the ones that differ.
+    With dry_run, print what would change instead, without writing anything.
+    Returns the number of targets that differed.
+    """
+    with _LOCK:
+        manifest = _load()
+        before = dict(manifest)
+        changed = 0
+
+        for entry in entries:
+            action = _action(entry, manifest)
+            if not action:
+                continue
+
+            changed += 1
+            if dry_run:
+                print(f"Would {action} {entry.target}")
+                if action == "update":
+                    _diff(entry)
+                continue
+
+            _apply(entry)
+            if not entry.link:
+                manifest[entry.target] = _record(entry)
+
+        if manifest != before and not dry_run:
+            write_json(MANIFEST_FILE, manifest)
+
+    return changed
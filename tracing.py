@@ -0,0 +1,146 @@
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+# utils imports this module, so its functions are only looked up when called
+import utils
+
+# set by the process that started tracing, so scripts it runs add to the same
+# trace
+TRACE_ENV = "DOTFILES_TRACE"
+
+# when set, spans are recorded and written here as Chrome trace events, which
+# can be opened in chrome://tracing or https://ui.perfetto.dev
+TRACE_FILE: None | str = os.environ.get(TRACE_ENV) or None
+
+# whether this process started tracing and writes the whole trace, rather
+# than its own part of it
+_OWNER = False
+
+_LOCK = threading.Lock()
+_EVENTS: list[dict] = []
+_THREADS: set[int] = set()
+
+
+def _now() -> int:
+    """
+    Wall clock time in microseconds, so spans from every process line up.
+    """
+    return time.time_ns() // 1000
+
+
+def _thread_event() -> None:
+    """
+    Name the current thread in the trace, the first time it records a span.
+    """
+    tid = threading.get_ident()
+    if tid in _THREADS:
+        return
+
+    _THREADS.add(tid)
+    _EVENTS.append(
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": {"name": threading.current_thread().name},
+        }
+    )
+
+
+def command_name(command: list[str]) -> str:
+    """
+    Short name of a command for its span, such as "sudo apt-get".
+    """
+    return " ".join([os.path.basename(command[0])] + command[1:2])
+
+
+@contextmanager
+def span(name: str, category: str, **args: Any) -> Iterator[None]:
+    """
+    Record how long the body takes, if tracing.
+    """
+    if not TRACE_FILE:
+        yield
+        return
+
+    start = _now()
+    begin = time.perf_counter_ns()
+    try:
+        yield
+    except BaseException as e:
+        args["error"] = repr(e)
+        raise
+    finally:
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start,
+            "dur": (time.perf_counter_ns() - begin) // 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": {key: str(value) for key, value in args.items()},
+        }
+        with _LOCK:
+            _thread_event()
+            _EVENTS.append(event)
+
+
+def _dump(path: str, events: list[dict]) -> None:
+    """
+    Atomically write a list of trace events, readable by everyone since part
+    of the trace may come from a process run with sudo.
+    """
+    utils.atomic_write(
+        path, json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}), mode=0o644
+    )
+
+
+def write() -> None:
+    """
+    Write the trace. Scripts that were run while tracing write their own part,
+    which the process that started tracing merges into the whole trace.
+    """
+    if not TRACE_FILE:
+        return
+
+    with _LOCK:
+        events = list(_EVENTS)
+
+    if not _OWNER:
+        _dump(f"{TRACE_FILE}.{os.getpid()}.part", events)
+        return
+
+    for part in sorted(glob.glob(f"{glob.escape(TRACE_FILE)}.*.part")):
+        try:
+            with open(part, "r") as fp:
+                events += json.load(fp)["traceEvents"]
+            os.remove(part)
+        except (OSError, ValueError) as e:
+            print(f"Could not read trace part {part} ({e})")
+
+    _dump(TRACE_FILE, events)
+    print(f"Trace written to {TRACE_FILE}")
+
+
+def start(path: str) -> None:
+    """
+    Start tracing this process and the scripts it runs, writing the trace to
+    the given path on exit.
+    """
+    global TRACE_FILE, _OWNER
+
+    TRACE_FILE = os.path.abspath(path)
+    _OWNER = True
+    os.environ[TRACE_ENV] = TRACE_FILE
+
+
+# write on exit, whether this process started tracing or was run by one that did
+atexit.register(write)
@@ -1,12 +1,736 @@
+import argparse
+import functools
+import json
+import os
+import random
+import re
 import shutil
 import subprocess
+import sys
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
-from utils import IS_LINUX, IS_WINDOWS
+import metrics
+import tracing
+from scheduler import Step, run_steps
+from utils import IS_LINUX, IS_WINDOWS, cache_dir, run_output, state_dir
 
+# keeps lines from managers running at the same time from mixing together
+_PRINT_LOCK = threading.Lock()
+# the open lock file, held until exit
+_LOCK_FP = None
 
-def main():
-    if pipx := shutil.which("pipx"):
-        subprocess.run([pipx, "upgrade-all"])
+# pipx venvs to upgrade at the same time
+PIPX_JOBS = 4
+
+APT_LISTS_DIR = "/var/lib/apt/lists"
+# apt update does not touch lists that have not changed, so remember when it
+# last succeeded
+APT_UPDATE_STAMP = os.path.join(state_dir(), "apt-update-stamp")
+# package lists younger than this are not refreshed
+APT_LISTS_TTL = 60 * 60
+# like apt upgrade, also install new packages that upgrades depend on, so
+# packages such as kernels are not held back
+APT_UPGRADE = ["upgrade", "--with-new-pkgs"]
+# seconds apt waits for other apt users, such as unattended-upgrades, to
+# release the dpkg lock, instead of failing right away
+APT_LOCK_TIMEOUT = 10 * 60
+
+# only download updates, to be applied by a later run
+STAGE = False
+# only apply updates that were downloaded ahead of time
+APPLY_STAGED = False
+# uv tools to upgrade at the same time
+UV_JOBS = 4
+# uv's cache is pruned this often, and cleared if it is still bigger than
+# the cap
+UV_PRUNE_INTERVAL = 7 * 24 * 60 * 60
+UV_CACHE_MAX_BYTES = int(os.environ.get("DOTFILES_UV_CACHE_MAX_MB", 5120)) * 1024 * 1024
+UV_PRUNE_STAMP = os.path.join(state_dir(), "uv-prune-stamp")
+# move pipx tools to uv before updating
+MIGRATE_PIPX = False
+
+# where downloaded pipx updates are kept until they are applied
+STAGE_DIR = os.path.join(cache_dir(), "staged")
+# keeps two runs from updating at the same time
+LOCK_FILE = os.path.join(state_dir(), "update.lock")
+# most seconds to wait before staging, so many hosts on the same schedule
+# do not all hit the mirrors at once
+STAGE_JITTER = 15 * 60
+
+
+@dataclass
+class Result:
+    """
+    What a package manager did: how long it took, how many packages it
+    changed and what went wrong.
+    """
+
+    manager: str
+    seconds: float = 0
+    changed: int = 0
+    failures: list[str] = field(default_factory=list)
+
+
+def output(prefix: str, line: str) -> None:
+    """
+    Print a line of output from a package manager.
+    """
+    with _PRINT_LOCK:
+        print(f"[{prefix}] {line}", flush=True)
+
+
+def run_prefixed(
+    result: Result,
+    command: list[str],
+    count: None | str = None,
+    prefix: None | str = None,
+) -> tuple[int, list[str]]:
+    """
+    Run a command, printing its output prefixed with the manager name, or
+    the prefix given. If a pattern is given, the number of packages changed
+    is read from the lines matching it, from the first group if there is
+    one. Failures are added to the result. Returns the exit code and output.
+    """
+    prefix = prefix or result.manager
+    command_line = " ".join(command)
+    output(prefix, command_line)
+
+    with tracing.span(
+        tracing.command_name(command), "subprocess", command=command_line
+    ):
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+        )
+
+        lines = []
+        assert process.stdout
+        for line in process.stdout:
+            line = line.rstrip()
+            lines.append(line)
+            output(prefix, line)
+
+            if count and (match := re.search(count, line)):
+                result.changed += int(match.group(1)) if match.groups() else 1
+
+        process.wait()
+
+    if process.returncode != 0:
+        result.failures.append(f"{command_line} exited with {process.returncode}")
+
+    return process.returncode, lines
+
+
+def manager(func: Callable[[Result], None]) -> Callable[[], Result]:
+    """
+    Decorator for a function that updates one package manager, to time it
+    and keep one failing manager from stopping the others.
+    """
+
+    @functools.wraps(func)
+    def wrapper() -> Result:
+        result = Result(func.__name__.removeprefix("update_"))
+        start = time.monotonic()
+        try:
+            func(result)
+        except Exception as e:
+            result.failures.append(f"{type(e).__name__}: {e}")
+        result.seconds = time.monotonic() - start
+        return result
+
+    return wrapper
+
+
+@dataclass
+class Tool:
+    """
+    A tool installed with pipx or uv, and what happened when upgrading it.
+    """
+
+    name: str
+    package: str
+    version: str
+    # a plain package name, rather than a URL or path
+    from_index: bool
+    pinned: bool = False
+    # packages injected into a pipx venv
+    injected: list[str] = field(default_factory=list)
+    latest: None | str = None
+    new_version: None | str = None
+    seconds: float = 0
+    status: str = ""
+
+
+def print_tools(result: Result, tools: list[Tool]) -> None:
+    """
+    Print what happened to each tool, and count the ones that changed.
+    """
+    for tool in tools:
+        version = tool.version
+        if tool.new_version:
+            version += f" -> {tool.new_version}"
+        output(
+            result.manager,
+            f"{tool.name:<24} {version:<24} {tool.seconds:5.1f}s  {tool.status}",
+        )
+
+    result.changed = sum(tool.status in ("upgraded", "staged") for tool in tools)
+
+
+def pipx_venvs(pipx: str) -> list[Tool]:
+    """
+    Read the tools installed with pipx.
+    """
+    with tracing.span("pipx list", "subprocess"):
+        data = json.loads(
+            subprocess.run(
+                [pipx, "list", "--json"], check=True, capture_output=True, text=True
+            ).stdout
+        )
+
+    venvs = []
+    for name, venv in sorted(data["venvs"].items()):
+        main_package = venv["metadata"]["main_package"]
+        venvs.append(
+            Tool(
+                name=name,
+                package=main_package["package"],
+                version=main_package["package_version"],
+                from_index=main_package["package_or_url"] == main_package["package"],
+                pinned=main_package.get("pinned", False),
+                injected=sorted(venv["metadata"].get("injected_packages") or {}),
+            )
+        )
+    return venvs
+
+
+def pipx_latest(pipx: str, venv: Tool) -> None | str:
+    """
+    The newest version of a tool on its package index, or None if that can
+    not be found out.
+    """
+    with tracing.span(f"pipx index versions {venv.package}", "subprocess"):
+        process = subprocess.run(
+            [pipx, "runpip", venv.name, "index", "versions", venv.package],
+            capture_output=True,
+            text=True,
+        )
+    # the first line is like "black (24.2.0)"
+    match = re.match(r"^\S+ \(([^)]+)\)", process.stdout)
+    return match.group(1) if process.returncode == 0 and match else None
+
+
+def pipx_stage_dir(venv: Tool) -> str:
+    """
+    Where the downloaded update for a tool is kept.
+    """
+    return os.path.join(STAGE_DIR, "pipx", venv.name)
+
+
+def pipx_staged_version(venv: Tool) -> None | str:
+    """
+    The version of a tool that has been downloaded ahead of time, if any.
+    """
+    try:
+        with open(os.path.join(pipx_stage_dir(venv), "version"), "r") as fp:
+            return fp.read().strip()
+    except OSError:
+        return None
+
+
+def pipx_stage(result: Result, pipx: str, venv: Tool) -> None:
+    """
+    Download the newest version of a tool and everything it needs, without
+    installing it.
+    """
+    start = time.monotonic()
+    directory = pipx_stage_dir(venv)
+
+    if pipx_staged_version(venv) == venv.latest:
+        venv.status = "already staged"
+    else:
+        shutil.rmtree(directory, ignore_errors=True)
+        returncode, _ = run_prefixed(
+            result,
+            [
+                pipx,
+                "runpip",
+                venv.name,
+                "download",
+                "--dest",
+                directory,
+                f"{venv.package}=={venv.latest}",
+            ],
+            prefix=f"pipx {venv.name}",
+        )
+
+        if returncode != 0:
+            venv.status = "failed"
+        else:
+            with open(os.path.join(directory, "version"), "w") as fp:
+                fp.write(f"{venv.latest}\n")
+            venv.new_version = venv.latest
+            venv.status = "staged"
+
+    venv.seconds = time.monotonic() - start
+
+
+def pipx_needs_upgrade(venv: Tool) -> bool:
+    """
+    Whether a tool may have a newer version to upgrade to.
+    """
+    if venv.pinned:
+        return False
+    # without a known newest version, let pipx find out
+    return venv.latest is None or venv.latest != venv.version
+
+
+def pipx_upgrade(result: Result, pipx: str, venv: Tool) -> None:
+    """
+    Upgrade one tool, from its downloaded update if there is one.
+    """
+    start = time.monotonic()
+    command = [pipx, "upgrade", venv.name]
+
+    staged = pipx_staged_version(venv)
+    if staged and (APPLY_STAGED or staged == venv.latest):
+        directory = pipx_stage_dir(venv)
+        command.append(f"--pip-args=--no-index --find-links={directory}")
+
+    returncode, lines = run_prefixed(result, command, prefix=f"pipx {venv.name}")
+    if staged and returncode == 0:
+        shutil.rmtree(pipx_stage_dir(venv), ignore_errors=True)
+    for line in lines:
+        if match := re.match(r"^upgraded package \S+ from \S+ to (\S+)", line):
+            venv.new_version = match.group(1)
+
+    if returncode != 0:
+        venv.status = "failed"
+    elif venv.new_version:
+        venv.status = "upgraded"
+    else:
+        venv.status = "up to date"
+
+    venv.seconds = time.monotonic() - start
+
+
+@manager
+def update_pipx(result: Result) -> None:
+    pipx = shutil.which("pipx") or "pipx"
+    venvs = pipx_venvs(pipx)
+
+    with ThreadPoolExecutor(max_workers=PIPX_JOBS) as pool:
+        if APPLY_STAGED:
+            # only what was downloaded ahead of time, without the network
+            for venv in venvs:
+                venv.latest = pipx_staged_version(venv) or venv.version
+        else:
+            indexed = [venv for venv in venvs if venv.from_index]
+            for venv, latest in zip(
+                indexed, pool.map(lambda venv: pipx_latest(pipx, venv), indexed)
+            ):
+                venv.latest = latest
+
+        pending = []
+        for venv in venvs:
+            if pipx_needs_upgrade(venv) and (venv.latest or not STAGE):
+                pending.append(venv)
+            else:
+                venv.status = "pinned" if venv.pinned else "up to date"
+
+        if STAGE:
+            # tools without a known newest version can not be staged
+            list(pool.map(lambda venv: pipx_stage(result, pipx, venv), pending))
+        else:
+            # the first upgrade may also upgrade the pip shared by every venv,
+            # so it runs on its own
+            if pending:
+                pipx_upgrade(result, pipx, pending[0])
+            list(pool.map(lambda venv: pipx_upgrade(result, pipx, venv), pending[1:]))
+
+    print_tools(result, venvs)
+
+
+def uv_run(command: list[str]) -> subprocess.CompletedProcess:
+    """
+    Run a uv command quietly.
+    """
+    with tracing.span(
+        tracing.command_name(command), "subprocess", command=" ".join(command)
+    ):
+        return subprocess.run(command, capture_output=True, text=True)
+
+
+def uv_tools(uv: str) -> list[Tool]:
+    """
+    Read the tools installed with uv, and their newest versions if uv is new
+    enough to tell.
+    """
+    tools = []
+    for line in uv_run([uv, "tool", "list"]).stdout.splitlines():
+        if match := re.match(r"^(\S+) v(\S+)", line):
+            name, version = match.groups()
+            tools.append(Tool(name, name, version, from_index=True))
+
+    process = uv_run([uv, "tool", "list", "--outdated"])
+    if process.returncode == 0:
+        outdated = dict(
+            re.findall(r"^(\S+) v\S+ \[latest: ([^\]]+)\]", process.stdout, re.M)
+        )
+        for tool in tools:
+            tool.latest = outdated.get(tool.name, tool.version)
+
+    return tools
+
+
+def uv_upgrade(result: Result, uv: str, tool: Tool) -> None:
+    """
+    Upgrade one tool with uv.
+    """
+    start = time.monotonic()
+
+    command = [uv, "tool", "upgrade", tool.name]
+    output(result.manager, " ".join(command))
+    process = uv_run(command)
+    for line in (process.stdout + process.stderr).splitlines():
+        output(f"uv {tool.name}", line)
+        if match := re.match(r"^Updated \S+ v\S+ -> v(\S+)", line):
+            tool.new_version = match.group(1)
+
+    if process.returncode != 0:
+        result.failures.append(f"{' '.join(command)} exited with {process.returncode}")
+        tool.status = "failed"
+    elif tool.new_version:
+        tool.status = "upgraded"
+    elif tool.latest and tool.latest != tool.version:
+        tool.status = "pinned"
+    else:
+        tool.status = "up to date"
+
+    tool.seconds = time.monotonic() - start
+
+
+def uv_cache_size(uv: str) -> int:
+    """
+    Size of uv's cache in bytes.
+    """
+    process = uv_run([uv, "cache", "size", "--preview-features", "cache-size"])
+    if process.returncode == 0 and process.stdout.strip().isdigit():
+        return int(process.stdout)
+
+    # uv is too old to tell, so add it up
+    directory = uv_run([uv, "cache", "dir"]).stdout.strip()
+    size = 0
+    for root, _, files in os.walk(directory):
+        for file in files:
+            path = os.path.join(root, file)
+            if not os.path.islink(path):
+                size += os.path.getsize(path)
+    return size
+
+
+def uv_prune_cache(result: Result, uv: str) -> None:
+    """
+    Remove unused entries from uv's cache once in a while, and everything if
+    it is still over the size cap.
+    """
+    try:
+        age = time.time() - os.path.getmtime(UV_PRUNE_STAMP)
+    except OSError:
+        age = UV_PRUNE_INTERVAL
+
+    # measuring a large cache is slow, so only do it when pruning
+    if age < UV_PRUNE_INTERVAL:
+        return
+
+    run_prefixed(result, [uv, "cache", "prune"])
+    os.makedirs(os.path.dirname(UV_PRUNE_STAMP), exist_ok=True)
+    with open(UV_PRUNE_STAMP, "w"):
+        pass
+
+    size = uv_cache_size(uv)
+    if size > UV_CACHE_MAX_BYTES:
+        output(result.manager, f"Cache is {size / 1024 / 1024:.0f} MB, clearing it")
+        run_prefixed(result, [uv, "cache", "clean"])
+
+
+def uv_migrate_pipx(uv: str) -> None:
+    """
+    Move tools installed with pipx to uv, at the same versions. Tools
+    installed from a URL or path, pinned, or with injected packages are left
+    with pipx.
+    """
+    pipx = shutil.which("pipx")
+    if not pipx:
+        return
+
+    installed = {tool.name for tool in uv_tools(uv)}
+    for venv in pipx_venvs(pipx):
+        if not venv.from_index or venv.pinned or venv.package in installed:
+            continue
+        if venv.injected:
+            print(
+                f"Keeping {venv.package} in pipx, it has injected packages"
+                f" {', '.join(venv.injected)}"
+            )
+            continue
+
+        print(f"Moving {venv.package} {venv.version} from pipx to uv")
+        # forced, to replace the commands pipx linked
+        exact = [uv, "tool", "install", "--force", f"{venv.package}=={venv.version}"]
+        if uv_run(exact).returncode != 0:
+            print(f"Could not install {venv.package} with uv, keeping it in pipx")
+            continue
+
+        # installing again without the version keeps it, but lets uv upgrade
+        # it later
+        if uv_run([uv, "tool", "install", "--force", venv.package]).returncode != 0:
+            print(f"Could not install {venv.package} with uv, keeping it in pipx")
+            uv_run([uv, "tool", "uninstall", venv.package])
+            # which also removed the commands pipx had linked
+            subprocess.run([pipx, "reinstall", venv.name], capture_output=True)
+            continue
+
+        subprocess.run([pipx, "uninstall", venv.name], capture_output=True)
+
+
+@manager
+def update_uv(result: Result) -> None:
+    uv = shutil.which("uv") or "uv"
+
+    if STAGE or APPLY_STAGED:
+        output(result.manager, "Tool upgrades can not be staged, skipping")
+        return
+
+    process = uv_run([uv, "self", "update"])
+    if process.returncode == 0:
+        for line in process.stderr.splitlines():
+            output(result.manager, line)
+    else:
+        # installed by another package manager, which updates it instead
+        output(result.manager, "uv can not update itself, skipping")
+
+    tools = uv_tools(uv)
+    pending = []
+    for tool in tools:
+        if tool.latest == tool.version:
+            tool.status = "up to date"
+        else:
+            pending.append(tool)
+
+    # uv locks its own cache, so tools can upgrade at the same time
+    with ThreadPoolExecutor(max_workers=UV_JOBS) as pool:
+        list(pool.map(lambda tool: uv_upgrade(result, uv, tool), pending))
+
+    print_tools(result, tools)
+    uv_prune_cache(result, uv)
+
+
+def sudo(*args: str) -> list[str]:
+    """
+    A command run as root. When staging, sudo fails instead of asking for a
+    password, since nobody is there to type it.
+    """
+    return ["sudo", "-n", *args] if STAGE else ["sudo", *args]
+
+
+def apt_get(*args: str) -> list[str]:
+    """
+    An apt-get command run as root, which waits for the dpkg lock.
+    """
+    return sudo("apt-get", "-o", f"DPkg::Lock::Timeout={APT_LOCK_TIMEOUT}", *args)
+
+
+@manager
+def update_snap(result: Result) -> None:
+    if STAGE or APPLY_STAGED:
+        # snapd has no way to download a refresh without installing it, but
+        # downloads pending refreshes in the background by itself
+        output(result.manager, "Refreshes can not be staged, skipping")
+        return
+
+    run_prefixed(
+        result, sudo(shutil.which("snap") or "snap", "refresh"), count=r"refreshed$"
+    )
+
+
+def apt_lists_age() -> float:
+    """
+    Seconds since the apt package lists were last refreshed.
+    """
+    paths = [APT_UPDATE_STAMP]
+    if os.path.isdir(APT_LISTS_DIR):
+        paths += [entry.path for entry in os.scandir(APT_LISTS_DIR) if entry.is_file()]
+
+    newest = max(
+        (os.path.getmtime(path) for path in paths if os.path.isfile(path)), default=0
+    )
+    return time.time() - newest
+
+
+def apt_pending(*args: str) -> int:
+    """
+    Number of packages an apt-get command would change, found out by
+    simulating it, which is quick and needs no lock.
+    """
+    simulation = run_output(["apt-get", "-s", *args])
+    return len(re.findall(r"^(?:Inst|Remv) ", simulation, flags=re.MULTILINE))
+
+
+@manager
+def update_apt(result: Result) -> None:
+    age = apt_lists_age()
+    if APPLY_STAGED:
+        output(result.manager, "Using the package lists from staging")
+    elif age < APT_LISTS_TTL:
+        output(result.manager, f"Package lists are {age / 60:.0f} minutes old")
+    else:
+        # apt-get, since apt's output is not meant to be parsed
+        returncode, _ = run_prefixed(result, apt_get("update", "-y"))
+        if returncode == 0:
+            os.makedirs(os.path.dirname(APT_UPDATE_STAMP), exist_ok=True)
+            with open(APT_UPDATE_STAMP, "w"):
+                pass
+
+    if not apt_pending(*APT_UPGRADE):
+        output(result.manager, "Nothing to upgrade")
+    elif STAGE:
+        # into /var/cache/apt/archives, where upgrade will find them
+        run_prefixed(
+            result,
+            apt_get(*APT_UPGRADE, "--download-only", "-y"),
+            count=r"^(\d+) upgraded",
+        )
+        return
+    else:
+        command = apt_get(*APT_UPGRADE, "-y")
+        if APPLY_STAGED:
+            command.append("--no-download")
+        run_prefixed(result, command, count=r"^(\d+) upgraded")
+
+    if STAGE:
+        return
+
+    if apt_pending("autoremove"):
+        run_prefixed(
+            result,
+            apt_get("autoremove", "-y"),
+            count=r"(\d+) to remove",
+        )
+    else:
+        output(result.manager, "Nothing to remove")
+
+
+@manager
+def update_winget(result: Result) -> None:
+    if STAGE or APPLY_STAGED:
+        output(result.manager, "Upgrades can not be staged, skipping")
+        return
+
+    # while sudo exists on Windows, it's not really an .exe
+    # or anything, so python doesn't like it.
+    run_prefixed(
+        result,
+        ["winget", "upgrade", "--all", "--accept-package-agreements"],
+        count=r"Successfully installed",
+    )
+
+
+def print_summary(results: list[Result]) -> None:
+    """
+    Print what every package manager did.
+    """
+    print()
+    print(f"{'manager':<10} {'time':>8} {'changed':>8}  result")
+    for result in results:
+        status = "; ".join(result.failures) if result.failures else "ok"
+        print(
+            f"{result.manager:<10} {result.seconds:7.1f}s {result.changed:>8}  {status}"
+        )
+
+
+def lower_priority() -> None:
+    """
+    Run this process and everything it starts at the lowest CPU and disk
+    priority, so it does not slow down anything else on the machine.
+    """
+    if IS_WINDOWS:
+        return
+
+    os.nice(19)
+    if ionice := shutil.which("ionice"):
+        # the idle class only gets the disk when nothing else wants it
+        subprocess.run([ionice, "-c", "3", "-p", str(os.getpid())])
+
+
+def take_lock(wait: bool) -> bool:
+    """
+    Make sure only one update runs at a time. The lock is released when this
+    process exits. Returns False if another run holds it and wait is False.
+    """
+    if IS_WINDOWS:
+        return True
+
+    import fcntl
+
+    os.makedirs(os.path.dirname(LOCK_FILE), exist_ok=True)
+    # kept open for the rest of the process
+    global _LOCK_FP
+    _LOCK_FP = open(LOCK_FILE, "w")
+
+    try:
+        fcntl.flock(_LOCK_FP, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        if not wait:
+            return False
+        print("Waiting for another update to finish")
+        fcntl.flock(_LOCK_FP, fcntl.LOCK_EX)
+
+    return True
+
+
+def main(jobs: int = 4, jitter: float = 0) -> int:
+    if STAGE:
+        lower_priority()
+        # before taking the lock, so waiting does not hold up other runs
+        delay = random.uniform(0, jitter)
+        print(f"Staging updates in {delay:.0f}s")
+        time.sleep(delay)
+
+    if not take_lock(wait=not STAGE):
+        print("Another update is running")
+        return 0
+
+    if IS_LINUX:
+        if STAGE:
+            # never wait for a password in the background
+            if subprocess.run(["sudo", "-n", "-v"]).returncode != 0:
+                print("sudo needs a password, can not stage updates")
+                return 1
+        else:
+            # ask for the password once, before output starts interleaving
+            subprocess.run(["sudo", "-v"])
+
+    if MIGRATE_PIPX and (uv := shutil.which("uv")):
+        if STAGE or APPLY_STAGED:
+            # like upgrading uv tools, this can not be staged
+            print("Moving pipx tools to uv can not be staged, skipping")
+        else:
+            uv_migrate_pipx(uv)
+
+    steps = []
+    if shutil.which("pipx"):
+        steps.append(Step(update_pipx))
+    if shutil.which("uv"):
+        steps.append(Step(update_uv))
 
     # if npm := shutil.which("npm"):
     #     if IS_WINDOWS:
@@ -17,18 +741,92 @@ def main():
     #     subprocess.run([brew, "upgrade"])
 
     if IS_LINUX:
-        if snap := shutil.which("snap"):
-            subprocess.run(["sudo", snap, "refresh"])
-
-        subprocess.run(["sudo", "apt", "update", "-y"])
-        subprocess.run(["sudo", "apt", "upgrade", "-y"])
-        subprocess.run(["sudo", "apt", "autoremove", "-y"])
+        if shutil.which("snap"):
+            steps.append(Step(update_snap, locks=["snap"]))
+        steps.append(Step(update_apt, locks=["apt"]))
 
     if IS_WINDOWS:
-        # while sudo exists on Windows, it's not really an .exe
-        # or anything, so python doesn't like it.
-        subprocess.run(["winget", "upgrade", "--all", "--accept-package-agreements"])
+        steps.append(Step(update_winget))
+
+    by_name = run_steps(steps, jobs=jobs)
+    results = [by_name[step.name] for step in steps]
+    print_summary(results)
+
+    for result in results:
+        metrics.add("packages_upgraded_total", result.changed, manager=result.manager)
+        metrics.add("failures_total", len(result.failures), manager=result.manager)
+
+    failed = any(result.failures for result in results)
+    metrics.write("update", failed)
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="Number of package managers to update at the same time",
+    )
+    parser.add_argument(
+        "--apt-ttl",
+        type=float,
+        default=APT_LISTS_TTL / 60,
+        metavar="MINUTES",
+        help="Only refresh apt package lists older than this",
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--stage",
+        action="store_true",
+        help="Download updates in the background at low priority, without "
+        "installing them",
+    )
+    mode.add_argument(
+        "--apply-staged",
+        action="store_true",
+        help="Only install updates that were downloaded with --stage",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=STAGE_JITTER,
+        metavar="SECONDS",
+        help="Most time to wait at random before staging",
+    )
+    parser.add_argument(
+        "--migrate-pipx",
+        action="store_true",
+        help="Move tools installed with pipx to uv, at the same versions",
+    )
+    parser.add_argument(
+        "--uv-cache-dir",
+        metavar="PATH",
+        help="Cache directory for uv, which can be shared between machines",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="Write a trace of this run here, to open in chrome://tracing or Perfetto",
+    )
+    parser.add_argument(
+        "--metrics-dir",
+        metavar="PATH",
+        help="Write metrics about this run here, as a Prometheus textfile and JSON",
+    )
+    args = parser.parse_args()
+
+    APT_LISTS_TTL = args.apt_ttl * 60
+    STAGE = args.stage
+    APPLY_STAGED = args.apply_staged
+    MIGRATE_PIPX = args.migrate_pipx
+    metrics.METRICS_DIR = args.metrics_dir
+    if args.trace:
+        tracing.start(args.trace)
+    if args.uv_cache_dir:
+        # for every uv command, including ones run by pipx
+        os.environ["UV_CACHE_DIR"] = args.uv_cache_dir
+
+    sys.exit(main(jobs=args.jobs, jitter=args.jitter))
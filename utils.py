@@ -1,14 +1,162 @@
+import hashlib
+import json
 import os
 import platform
 import shutil
+import stat
 import subprocess
 import sys
+import tempfile
+from typing import Any
+
+import tracing
 
 IS_LINUX = os.name == "posix"
 IS_WINDOWS = os.name == "nt"
 IS_WSL = "microsoft-standard" in platform.uname().release
 
 
+def cache_dir() -> str:
+    """
+    Directory to keep things in between runs.
+    """
+    if IS_WINDOWS:
+        base = os.environ["LOCALAPPDATA"]
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "dotfiles")
+
+
+def state_dir() -> str:
+    """
+    Directory to keep a record of what has been done in.
+    """
+    if IS_WINDOWS:
+        return os.path.join(os.environ["LOCALAPPDATA"], "dotfiles", "state")
+
+    base = os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+    return os.path.join(base, "dotfiles")
+
+
+def file_hash(path: str, algorithm: str) -> str:
+    """
+    Returns the hash of a file, with any algorithm hashlib supports.
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as fp:
+        while chunk := fp.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_sha256(path: str) -> str:
+    """
+    Returns the SHA256 hash of a file.
+    """
+    return file_hash(path, "sha256")
+
+
+def atomic_write(path: str, data: str | bytes, mode: None | int = None) -> None:
+    """
+    Write a file atomically, so nothing ever reads half of it. Unless a mode
+    is given, an existing file keeps its permissions, and a new one is
+    readable by everyone.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    if mode is None:
+        mode = stat.S_IMODE(os.stat(path).st_mode) if os.path.isfile(path) else 0o644
+
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "wb" if isinstance(data, bytes) else "w") as fp:
+        fp.write(data)
+    os.chmod(tmp, mode)
+    os.replace(tmp, path)
+
+
+def write_json(path: str, data: Any) -> None:
+    """
+    Atomically write a JSON file.
+    """
+    atomic_write(path, json.dumps(data, indent=2))
+
+
+class LineEditor:
+    """
+    Loads a file once, so any number of lines can be added or replaced in
+    memory, then writes it back atomically if anything changed. Use as a
+    context manager to commit automatically.
+    """
+
+    def __init__(self, filename: str) -> None:
+        # edit the real file, in case it is a symlink
+        self.filename = os.path.realpath(filename)
+
+        if os.path.isfile(self.filename):
+            with open(self.filename, "r") as fp:
+                self.lines = fp.readlines()
+        else:
+            self.lines = []
+
+        self.original = list(self.lines)
+
+        # first line starting with each word, and every full line, without
+        # newlines since the last line may not have one
+        self.by_key: dict[str, int] = {}
+        self.full_lines: set[str] = set()
+        for i, line in enumerate(self.lines):
+            self.by_key.setdefault(self._key(line), i)
+            self.full_lines.add(line.rstrip("\n"))
+
+    def __enter__(self) -> "LineEditor":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.commit()
+
+    @staticmethod
+    def _key(line: str) -> str:
+        return line.rstrip("\n").split(" ", maxsplit=1)[0]
+
+    def upsert(self, newline: str, match_full_line: bool = False) -> None:
+        """
+        Add a line. Unless the full line has to match, an existing line
+        starting with the same word is replaced instead.
+        """
+        if newline in self.full_lines:
+            return
+
+        key = self._key(newline)
+        if not match_full_line and key in self.by_key:
+            i = self.by_key[key]
+            self.full_lines.discard(self.lines[i].rstrip("\n"))
+            self.lines[i] = newline + "\n"
+        else:
+            # don't join onto a last line without a newline
+            if self.lines and not self.lines[-1].endswith("\n"):
+                self.lines[-1] += "\n"
+
+            self.by_key.setdefault(key, len(self.lines))
+            self.lines.append(newline + "\n")
+
+        self.full_lines.add(newline)
+
+    def commit(self) -> bool:
+        """
+        Write the file if it changed, keeping its permissions. Returns if
+        it was written.
+        """
+        if self.lines == self.original:
+            return False
+
+        atomic_write(self.filename, "".join(self.lines))
+
+        self.original = list(self.lines)
+        return True
+
+
 def which(program: str) -> str:
     """
     shutil.which, but with an assert to make sure the program was found.
@@ -26,10 +174,20 @@ def run(command: list[str], check: bool = True) -> None:
     cmd = [which(command[0])] + command[1:]
     print(f"\t{' '.join(cmd)}")
 
-    if check:
-        subprocess.check_call(cmd)
-    else:
-        subprocess.run(cmd)
+    with tracing.span(tracing.command_name(cmd), "subprocess", command=" ".join(cmd)):
+        if check:
+            subprocess.check_call(cmd)
+        else:
+            subprocess.run(cmd)
+
+
+def run_output(command: list[str], check: bool = True) -> str:
+    """
+    Runs a command quietly and returns its output
+    """
+    cmd = [which(command[0])] + command[1:]
+    with tracing.span(tracing.command_name(cmd), "subprocess", command=" ".join(cmd)):
+        return subprocess.run(cmd, check=check, capture_output=True, text=True).stdout
 
 
 def check_sudo() -> None: